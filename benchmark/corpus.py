@@ -0,0 +1,97 @@
+"""Набор тестовых изображений для бенчмарков.
+
+Изображения берутся из каталога (файл картинки + одноименный .txt с эталонным
+текстом) или генерируются: строки учебного текста с неравномерным освещением,
+наклоном, шумом и JPEG-сжатием, как у фото тетради с телефона.
+"""
+import io
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+SAMPLE_LINES = [
+    "Что такое фотосинтез? Опишите основные стадии процесса.",
+    "Решите уравнение: 3x + 7 = 22. Найдите значение x.",
+    "Назовите причины Первой мировой войны и ее итоги.",
+    "Определите плотность тела массой 2 кг и объемом 0,5 м3.",
+    "Какие функции выполняет митохондрия в клетке?",
+    "Переведите на английский: Я люблю читать книги.",
+    "Вычислите площадь круга радиусом 4 см.",
+    "Explain the difference between weather and climate.",
+    "Сформулируйте закон сохранения энергии.",
+    "Найдите производную функции f(x) = x^2 + 3x - 5.",
+]
+
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+]
+
+def load_font(size):
+    for path in FONT_CANDIDATES:
+        if os.path.exists(path):
+            return ImageFont.truetype(path, size), True
+    # Встроенный шрифт Pillow не содержит кириллицы
+    return ImageFont.load_default(size=size), False
+
+def render_page(lines, rng, width=1600, font_size=34):
+    """Рисует страницу с текстом и искажениями, возвращает (JPEG-байты, эталон)"""
+    font, cyrillic = load_font(font_size)
+    if not cyrillic:
+        lines = [line for line in lines if line.isascii()] or ["Explain the difference between weather and climate."]
+    line_height = int(font_size * 1.6)
+    height = line_height * (len(lines) + 2)
+    page = Image.new('L', (width, height), 235)
+    draw = ImageDraw.Draw(page)
+    for i, line in enumerate(lines):
+        draw.text((60, line_height * (i + 1)), line, fill=30, font=font)
+
+    # Неравномерное освещение: затемнение к одному из углов
+    shade = Image.linear_gradient('L').rotate(rng.choice([0, 90, 180, 270])).resize(page.size)
+    shade = shade.point(lambda p: int(p * 0.45))
+    page = Image.composite(Image.new('L', page.size, 0), page, shade)
+
+    page = page.rotate(rng.uniform(-3, 3), resample=Image.BICUBIC, expand=True, fillcolor=200)
+    noise = Image.effect_noise(page.size, 12).filter(ImageFilter.GaussianBlur(0.6))
+    page = Image.blend(page, noise, 0.08)
+
+    buffer = io.BytesIO()
+    page.convert('RGB').save(buffer, 'JPEG', quality=rng.randint(70, 90))
+    return buffer.getvalue(), "\n".join(lines)
+
+def generate_corpus(count=8, seed=1):
+    """Генерирует count страниц по 3-6 строк, детерминированно для seed"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        lines = rng.sample(SAMPLE_LINES, rng.randint(3, 6))
+        data, truth = render_page(lines, rng)
+        corpus.append((f"synthetic-{i:02d}.jpg", data, truth))
+    return corpus
+
+def load_corpus(directory):
+    """Читает изображения и эталонные тексты из каталога"""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        with open(os.path.join(directory, name), 'rb') as f:
+            data = f.read()
+        truth_path = os.path.join(directory, base + '.txt')
+        truth = None
+        if os.path.exists(truth_path):
+            with open(truth_path, encoding='utf-8') as f:
+                truth = f.read()
+        corpus.append((name, data, truth))
+    return corpus
+
+def get_corpus(directory=None, count=8):
+    if directory:
+        return load_corpus(directory)
+    return generate_corpus(count)
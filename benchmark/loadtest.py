@@ -0,0 +1,358 @@
+"""Сквозной нагрузочный тест бота без обращения к Telegram и OpenRouter.
+
+Запускает заменители API из stubs.py, поднимает приложение (в этом же
+процессе или через gunicorn) и с заданной частотой отправляет на /webhook
+синтетические обновления: текстовые вопросы, кнопки меню и фото из набора
+corpus.py. Для каждого сценария используется отдельный чат; время ответа -
+от отправки первого обновления до последнего вызова Bot API в этом чате.
+
+    python benchmark/loadtest.py --rate 5 --duration 30 --output run.json
+    python benchmark/loadtest.py --gunicorn 4 --compare run.json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from corpus import get_corpus
+from stubs import OpenRouterStub, TelegramStub
+
+BOT_TOKEN = "123456:benchmark"
+
+QUESTIONS = [
+    "Что такое фотосинтез?",
+    "Объясни закон Ома",
+    "Кто написал «Войну и мир»?",
+    "Что такое производная функции?",
+    "Чем отличается вирус от бактерии?",
+    "Как решать квадратные уравнения?",
+    "Назови столицы стран Скандинавии",
+    "Что такое валентность химического элемента?",
+]
+MENU_BUTTONS = ['/start', '📚 История', 'ℹ️ Помощь', '📷 Отправить фото']
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def process_tree_rss(pid):
+    """Суммарный RSS процесса и его потомков в байтах (Linux /proc)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._finished = threading.Event()
+
+    def run(self):
+        while not self._finished.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._finished.wait(self.interval)
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+class UpdateFactory:
+    """Строит JSON обновлений Telegram для сценариев"""
+
+    def __init__(self, telegram, corpus, seed):
+        self.rng = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chat_ids = itertools.count(10_000)
+        self.photos = [telegram.add_photo(f"photo{i}", data) for i, (_, data, _) in enumerate(corpus)]
+
+    def message(self, chat_id, **fields):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        }
+        message.update(fields)
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def scenario(self, kind):
+        """Возвращает (chat_id, [(задержка, обновление), ...])"""
+        chat_id = next(self.chat_ids)
+        if kind == 'question':
+            return chat_id, [
+                (0.0, self.message(chat_id, text='📝 Задать вопрос')),
+                (0.3, self.message(chat_id, text=self.rng.choice(QUESTIONS))),
+            ]
+        if kind == 'photo':
+            return chat_id, [(0.0, self.message(chat_id, photo=self.rng.choice(self.photos)))]
+        button = self.rng.choice(MENU_BUTTONS)
+        fields = {"text": button}
+        if button.startswith('/'):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(button)}]
+        return chat_id, [(0.0, self.message(chat_id, **fields))]
+
+def start_app(args, env):
+    """Запускает приложение; возвращает (базовый URL, pid для замера памяти, функция остановки)"""
+    if args.gunicorn:
+        port = args.port
+        env = dict(os.environ, **env, WEB_CONCURRENCY=str(args.gunicorn), PORT=str(port))
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'bot:app'],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL if args.quiet else None, stderr=subprocess.STDOUT
+        )
+
+        def stop():
+            proc.terminate()
+            proc.wait(timeout=30)
+        return f"http://127.0.0.1:{port}", proc.pid, stop
+
+    os.environ.update(env)
+    import logging
+    if args.quiet:
+        logging.disable(logging.INFO)
+    from werkzeug.serving import make_server
+    import bot
+    server = make_server('127.0.0.1', args.port, bot.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{args.port}", os.getpid(), server.shutdown
+
+def wait_ready(base_url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/health/ready", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Приложение не стало готовым вовремя")
+
+def run(args):
+    corpus = get_corpus(args.corpus, args.corpus_size)
+    telegram = TelegramStub(args.telegram_latency, args.telegram_error_rate).start()
+    openrouter = OpenRouterStub(
+        args.llm_latency, args.llm_token_delay, args.llm_tokens, args.llm_error_rate
+    ).start()
+    data_dir = tempfile.mkdtemp(prefix='studybot-bench-')
+    env = {
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "OPENROUTER_API_KEY": "benchmark",
+        "TELEGRAM_API_URL": telegram.url,
+        "OPENROUTER_BASE_URL": openrouter.url,
+        "DATA_DIR": data_dir,
+        "PROMETHEUS_MULTIPROC_DIR": tempfile.mkdtemp(prefix='studybot-metrics-'),
+        "LLM_STREAMING": '1' if args.streaming else '0',
+    }
+    if args.no_cache:
+        env.update(ANSWER_CACHE_TTL='0', ANSWER_CACHE_DB='', OCR_CACHE_ENTRIES='0', OCR_CACHE_DB='')
+    if not args.gunicorn:
+        # Без gunicorn метрики не нужно собирать из нескольких процессов
+        del env["PROMETHEUS_MULTIPROC_DIR"]
+
+    base_url, pid, stop_app = start_app(args, env)
+    sampler = RSSSampler(pid)
+    sampler.start()
+    try:
+        wait_ready(base_url)
+        factory = UpdateFactory(telegram, corpus, args.seed)
+        weights = {'question': args.mix[0], 'menu': args.mix[1], 'photo': args.mix[2]}
+        kinds = [kind for kind, weight in weights.items() if weight > 0]
+        rng = random.Random(args.seed)
+
+        session = requests.Session()
+        statuses = {}
+        scenarios = []
+        status_lock = threading.Lock()
+
+        def post(update):
+            try:
+                status = session.post(f"{base_url}/webhook", json=update, timeout=120).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            with status_lock:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        def play(steps):
+            for delay, update in steps:
+                if delay:
+                    time.sleep(delay)
+                post(update)
+
+        total = int(args.rate * args.duration)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for i in range(total):
+                target = started + i / args.rate
+                pause = target - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+                kind = rng.choices(kinds, [weights[k] for k in kinds])[0]
+                chat_id, steps = factory.scenario(kind)
+                scenarios.append((kind, chat_id, time.monotonic(), len(steps)))
+                pool.submit(play, steps)
+
+            # Ждем, пока бот перестанет отправлять сообщения
+            last_count = -1
+            while True:
+                time.sleep(args.drain)
+                with telegram.lock:
+                    count = len(telegram.events)
+                if count == last_count:
+                    break
+                last_count = count
+    finally:
+        sampler.stop()
+        stop_app()
+        telegram.stop()
+        openrouter.stop()
+
+    return build_report(args, scenarios, telegram, openrouter, statuses, started, sampler.peak)
+
+def build_report(args, scenarios, telegram, openrouter, statuses, started, peak_rss):
+    last_event = {}
+    calls = {}
+    for at, method, chat_id, _ in telegram.events:
+        calls[method] = calls.get(method, 0) + 1
+        if chat_id is not None:
+            key = int(chat_id)
+            last_event[key] = max(last_event.get(key, 0), at)
+
+    latencies = {}
+    unanswered = 0
+    updates = 0
+    finished_at = started
+    for kind, chat_id, sent_at, steps in scenarios:
+        updates += steps
+        if chat_id not in last_event:
+            unanswered += 1
+            continue
+        finished_at = max(finished_at, last_event[chat_id])
+        latencies.setdefault(kind, []).append(last_event[chat_id] - sent_at)
+
+    def summary(values):
+        return {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values) if values else None,
+        }
+
+    elapsed = max(finished_at - started, 1e-9)
+    all_latencies = [v for values in latencies.values() for v in values]
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        "timestamp": time.time(),
+        "scenarios": len(scenarios),
+        "unanswered": unanswered,
+        "updates": updates,
+        "updates_per_second": round(updates / elapsed, 3),
+        "latency": summary(all_latencies),
+        "latency_by_kind": {kind: summary(values) for kind, values in latencies.items()},
+        "peak_rss_bytes": peak_rss,
+        "benchmark_maxrss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "webhook_statuses": statuses,
+        "telegram_calls": calls,
+        "openrouter": {"requests": openrouter.requests, "errors": openrouter.errors},
+    }
+
+def compare(report, baseline, tolerance):
+    """Печатает изменения относительно baseline; True, если есть регрессия"""
+    regressed = False
+    for key in ('p50', 'p95', 'p99'):
+        new, old = report['latency'][key], baseline['latency'][key]
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        flag = ' РЕГРЕССИЯ' if change > tolerance else ''
+        regressed |= bool(flag)
+        print(f"  {key}: {old:.3f} -> {new:.3f} с ({change:+.1%}){flag}")
+    # Нагрузка подается с постоянной частотой, поэтому пропускная способность
+    # только выводится: она зависит от --rate больше, чем от кода
+    print(f"  updates/s: {baseline['updates_per_second']:.2f} -> {report['updates_per_second']:.2f}")
+    if report['unanswered'] > baseline['unanswered']:
+        print(f"  без ответа: {baseline['unanswered']} -> {report['unanswered']} РЕГРЕССИЯ")
+        regressed = True
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=2.0, help="сценариев в секунду")
+    parser.add_argument('--duration', type=float, default=20.0, help="длительность подачи нагрузки, с")
+    parser.add_argument('--mix', type=lambda v: [float(x) for x in v.split(',')], default=[0.6, 0.2, 0.2],
+                        help="доли сценариев вопрос,меню,фото")
+    parser.add_argument('--corpus', help="каталог с изображениями; по умолчанию синтетический набор")
+    parser.add_argument('--corpus-size', type=int, default=6)
+    parser.add_argument('--gunicorn', type=int, default=0, help="запустить gunicorn с N процессами")
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--concurrency', type=int, default=64, help="параллельных отправителей")
+    parser.add_argument('--drain', type=float, default=3.0, help="тишина в Bot API, после которой тест завершается, с")
+    parser.add_argument('--streaming', type=int, default=1, choices=(0, 1))
+    parser.add_argument('--no-cache', action='store_true', help="отключить кэши ответов и OCR")
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--llm-latency', type=float, default=1.0, help="задержка до первого токена, с")
+    parser.add_argument('--llm-token-delay', type=float, default=0.02)
+    parser.add_argument('--llm-tokens', type=int, default=120)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--quiet', action='store_true', help="не выводить логи бота")
+    parser.add_argument('--output', help="сохранить отчет в JSON")
+    parser.add_argument('--compare', help="сравнить с сохраненным отчетом")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="допустимое ухудшение для --compare")
+    args = parser.parse_args()
+
+    report = run(args)
+    latency = report['latency']
+    print(f"Сценариев: {report['scenarios']}, без ответа: {report['unanswered']}, обновлений/с: {report['updates_per_second']}")
+    if latency['count']:
+        print(f"Задержка p50/p95/p99: {latency['p50']:.3f} / {latency['p95']:.3f} / {latency['p99']:.3f} с")
+    for kind, summary in report['latency_by_kind'].items():
+        print(f"  {kind:<9} n={summary['count']:<5} p50={summary['p50']:.3f} p95={summary['p95']:.3f} p99={summary['p99']:.3f}")
+    print(f"Пиковый RSS: {report['peak_rss_bytes'] / 1024 / 1024:.1f} МБ")
+    print(f"Ответы вебхука: {report['webhook_statuses']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"Сравнение с {args.compare}:")
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Микробенчмарк предобработки для OCR.
+
+Сравнивает время каждого этапа и точность распознавания для всех режимов
+preprocess.PREPROCESS_MODES на наборе изображений.
+
+    python benchmark/preprocess_bench.py
+    python benchmark/preprocess_bench.py --corpus samples/ --repeat 5 --output preprocess.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytesseract
+
+from corpus import get_corpus
+from preprocess import PREPROCESS_MODES, decode_image, preprocess_image
+
+OCR_CONFIG = '--oem 3 --psm 6 -l rus+eng'
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+def levenshtein(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def char_accuracy(recognized, truth):
+    """1 - CER: доля верно распознанных символов"""
+    recognized, truth = normalize(recognized), normalize(truth)
+    if not truth:
+        return None
+    return max(0.0, 1.0 - levenshtein(recognized, truth) / len(truth))
+
+def run_mode(mode, corpus, dpi, repeat, with_ocr):
+    stages = {}
+    totals = []
+    accuracies = []
+    for name, data, truth in corpus:
+        for _ in range(repeat):
+            timings = {}
+            start = time.perf_counter()
+            image = decode_image(data, None if mode == 'legacy' else dpi)
+            image.load()
+            timings['decode'] = time.perf_counter() - start
+            processed = preprocess_image(image, mode, dpi, timings)
+            totals.append(time.perf_counter() - start)
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+        if with_ocr:
+            start = time.perf_counter()
+            text = pytesseract.image_to_string(processed, config=OCR_CONFIG)
+            stages.setdefault('ocr', []).append(time.perf_counter() - start)
+            if truth:
+                accuracy = char_accuracy(text, truth)
+                if accuracy is not None:
+                    accuracies.append(accuracy)
+    return {
+        "mode": mode,
+        "images": len(corpus),
+        "preprocess_ms": round(statistics.median(totals) * 1000, 2),
+        "stages_ms": {stage: round(statistics.median(values) * 1000, 2) for stage, values in stages.items()},
+        "accuracy": round(statistics.mean(accuracies), 4) if accuracies else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--corpus', help="каталог с изображениями и .txt-эталонами; по умолчанию синтетический набор")
+    parser.add_argument('--count', type=int, default=8, help="размер синтетического набора")
+    parser.add_argument('--modes', default=','.join(PREPROCESS_MODES))
+    parser.add_argument('--dpi', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3, help="повторов предобработки на изображение")
+    parser.add_argument('--no-ocr', action='store_true', help="не запускать Tesseract, только время этапов")
+    parser.add_argument('--output', help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    corpus = get_corpus(args.corpus, args.count)
+    results = [
+        run_mode(mode, corpus, args.dpi, args.repeat, not args.no_ocr)
+        for mode in args.modes.split(',')
+    ]
+
+    for result in results:
+        accuracy = f"{result['accuracy']:.3f}" if result['accuracy'] is not None else "-"
+        stages = ", ".join(f"{stage} {ms}" for stage, ms in result['stages_ms'].items())
+        print(f"{result['mode']:<9} {result['preprocess_ms']:>8.1f} ms  точность {accuracy:<6} [{stages}]")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"dpi": args.dpi, "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
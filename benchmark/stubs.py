@@ -0,0 +1,250 @@
+"""Локальные заменители Telegram Bot API и OpenRouter для нагрузочных тестов.
+
+Оба сервера отвечают так же, как настоящие API, в объеме, который использует
+bot.py, с настраиваемыми задержками и долей ошибок, и записывают все вызовы.
+"""
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент закрывает keep-alive соединения при остановке теста - это не ошибка
+        pass
+
+class StubServer:
+    """Запускает HTTP-сервер в фоновом потоке на свободном порту"""
+
+    def __init__(self, handler_class):
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.stub = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_params(self):
+        """Параметры из строки запроса и тела (telebot передает их в query string)"""
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if body and 'json' in content_type:
+            params.update(json.loads(body))
+        elif body and 'x-www-form-urlencoded' in content_type:
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return parsed.path, params
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+class TelegramStub(StubServer):
+    """Заменитель Bot API: /bot<token>/<method> и /file/bot<token>/<path>"""
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=1):
+        super().__init__(TelegramHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.next_message_id = 1000
+
+    def add_photo(self, file_id, data):
+        """Регистрирует JPEG и его уменьшенные копии, возвращает массив PhotoSize"""
+        image = Image.open(io.BytesIO(data))
+        sizes = []
+        for limit in (320, 800, 1280, 2560):
+            variant_id = f"{file_id}-{limit}"
+            if max(image.size) > limit:
+                copy = image.copy()
+                copy.thumbnail((limit, limit))
+                buffer = io.BytesIO()
+                copy.convert('RGB').save(buffer, 'JPEG', quality=85)
+                variant, size = buffer.getvalue(), copy.size
+            else:
+                variant, size = data, image.size
+            self.files[variant_id] = variant
+            sizes.append({
+                "file_id": variant_id,
+                "file_unique_id": f"u-{variant_id}",
+                "width": size[0],
+                "height": size[1],
+                "file_size": len(variant)
+            })
+            if max(image.size) <= limit:
+                break
+        return sizes
+
+    def record(self, method, params):
+        with self.lock:
+            self.events.append((time.monotonic(), method, params.get('chat_id'), params.get('text')))
+
+    def message(self, params):
+        with self.lock:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        chat_id = int(params.get('chat_id', 0))
+        return {
+            "message_id": int(params.get('message_id', message_id)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get('text', '')
+        }
+
+class TelegramHandler(QuietHandler):
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        stub = self.server.stub
+        path, params = self.read_params()
+        parts = path.strip('/').split('/')
+        if parts[0] == 'file':
+            file_id = parts[-1].rsplit('.', 1)[0]
+            data = stub.files.get(file_id)
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        method = parts[-1]
+        if stub.latency:
+            time.sleep(stub.latency)
+        if method not in ('getFile', 'setWebhook', 'deleteWebhook', 'getWebhookInfo') and stub.rng.random() < stub.error_rate:
+            stub.record(f"{method}:429", params)
+            self.send_json(429, {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            })
+            return
+        stub.record(method, params)
+
+        if method in ('sendMessage', 'editMessageText'):
+            result = stub.message(params)
+        elif method == 'getFile':
+            file_id = params.get('file_id')
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(stub.files.get(file_id, b'')),
+                "file_path": f"photos/{file_id}.jpg"
+            }
+        elif method == 'getWebhookInfo':
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True
+        self.send_json(200, {"ok": True, "result": result})
+
+class OpenRouterStub(StubServer):
+    """Заменитель OpenRouter: /chat/completions (обычный и SSE), /models, /auth/key"""
+
+    def __init__(self, latency=1.0, token_delay=0.02, tokens=120, error_rate=0.0, models=None, seed=2):
+        super().__init__(OpenRouterHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.models = models or ["qwen/qwen2.5-72b-chat"]
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def answer_tokens(self, prompt):
+        words = ["Ответ", "на", "вопрос", "«", prompt[:40], "»:", "это", "учебный", "пример", "текста."]
+        return [words[i % len(words)] + " " for i in range(self.tokens)]
+
+class OpenRouterHandler(QuietHandler):
+
+    def do_GET(self):
+        stub = self.server.stub
+        path, _ = self.read_params()
+        if path.endswith('/models'):
+            self.send_json(200, {"data": [{"id": model} for model in stub.models]})
+        else:
+            self.send_json(200, {"data": {"label": "stub"}})
+
+    def do_POST(self):
+        stub = self.server.stub
+        _, payload = self.read_params()
+        with stub.lock:
+            stub.requests += 1
+            failed = stub.rng.random() < stub.error_rate
+            if failed:
+                stub.errors += 1
+        if failed:
+            self.send_json(429, {"error": {"code": 429, "message": "Rate limit exceeded"}}, {"Retry-After": "1"})
+            return
+
+        prompt = payload['messages'][-1]['content']
+        tokens = stub.answer_tokens(prompt)[:payload.get('max_tokens', stub.tokens)]
+        time.sleep(stub.latency)
+        if not payload.get('stream'):
+            time.sleep(stub.token_delay * len(tokens))
+            self.send_json(200, {
+                "model": payload['model'],
+                "choices": [{"message": {"role": "assistant", "content": ''.join(tokens)}}]
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_chunk(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        write_chunk(b": OPENROUTER PROCESSING\n\n")
+        for token in tokens:
+            event = {"model": payload['model'], "choices": [{"delta": {"content": token}}]}
+            write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            time.sleep(stub.token_delay)
+        write_chunk(b"data: [DONE]\n\n")
+        write_chunk(b"")
@@ -3,13 +3,33 @@ import telebot
 import requests
 import logging
 import pytesseract
-from PIL import Image, ImageEnhance, ImageOps, ImageFilter
-import io
+from PIL import Image
 from flask import Flask, request
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton
+from telebot.apihelper import ApiHTTPException, ApiTelegramException
+from telebot.handler_backends import HandlerBackend
+import heapq
 import re
 import time
 import json
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from preprocess import PREPROCESS_MODES, decode_image, preprocess_image
+import queue
+import threading
+import random
+import select
+import struct
+import subprocess
+import sys
+import sqlite3
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import atexit
+import fcntl
+from abc import ABC, abstractmethod
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 
 # Настройка логирования
 logging.basicConfig(
@@ -31,16 +51,93 @@ if not OPENROUTER_API_KEY:
     logger.error("OPENROUTER_API_KEY не установлен!")
     raise ValueError("OPENROUTER_API_KEY не установлен")
 
-bot = telebot.TeleBot(BOT_TOKEN)
-logger.info("Бот инициализирован")
+# Режим обработки вебхуков: async - обновление ставится в очередь и сразу
+# подтверждается Telegram, sync - обрабатывается внутри HTTP-запроса
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'async')
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 500))
+# Сколько секунд при остановке процесса дообрабатываются принятые обновления
+# и альбомы (должно быть меньше graceful_timeout в gunicorn.conf.py)
+UPDATE_DRAIN_TIMEOUT = float(os.environ.get('UPDATE_DRAIN_TIMEOUT', 20))
+# Число процессов веб-сервера (задает gunicorn.conf.py): ядра под OCR делятся между ними
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+OCR_CONCURRENCY = int(os.environ.get('OCR_CONCURRENCY', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', 8))
+
+# Исходящие вызовы Bot API идут через очередь с ограничением частоты:
+# около 1 сообщения в секунду на чат и 30 в секунду на бота (делятся между процессами)
+TELEGRAM_SENDERS = int(os.environ.get('TELEGRAM_SENDERS', 4))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30 / WEB_CONCURRENCY))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_SEND_RETRIES = int(os.environ.get('TELEGRAM_SEND_RETRIES', 5))
+
+# Контроль перегрузки: пороги уровней reduced, cache_only, shed для заполнения
+# очереди обновлений (доля) и очереди OCR (задач на слот), для p95 ожидания
+# свободного слота ИИ - только reduced и cache_only (секунды). Ожидается именно
+# слот, а не ответ: длинный ответ модели сам по себе не признак перегрузки
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+ADMISSION_QUEUE_LEVELS = [float(v) for v in os.environ.get('ADMISSION_QUEUE_LEVELS', '0.25,0.5,0.8').split(',')]
+ADMISSION_OCR_LEVELS = [float(v) for v in os.environ.get('ADMISSION_OCR_LEVELS', '2,4,8').split(',')]
+ADMISSION_LLM_LEVELS = [float(v) for v in os.environ.get('ADMISSION_LLM_LEVELS', '2,10').split(',')]
+ADMISSION_INTERVAL = float(os.environ.get('ADMISSION_INTERVAL', 1))
+ADMISSION_COOLDOWN = float(os.environ.get('ADMISSION_COOLDOWN', 15))
+# Что урезается начиная с уровня reduced
+ADMISSION_OCR_DPI = int(os.environ.get('ADMISSION_OCR_DPI', 150))
+ADMISSION_PROMPT_CHARS = int(os.environ.get('ADMISSION_PROMPT_CHARS', 1500))
+ADMISSION_MAX_TOKENS = int(os.environ.get('ADMISSION_MAX_TOKENS', 800))
+
+# В async-режиме обработчики выполняются в нашем пуле воркеров,
+# поэтому собственный пул потоков telebot не нужен
+bot = telebot.TeleBot(BOT_TOKEN, threaded=WEBHOOK_MODE != 'async')
+
+# Метрики Prometheus. При запуске через gunicorn значения процессов
+# складываются в PROMETHEUS_MULTIPROC_DIR и объединяются в /metrics
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 45, 60, 90, 120)
+WEBHOOK_LATENCY = Histogram('studybot_webhook_seconds', 'Время обработки HTTP-запроса вебхука')
+UPDATE_LATENCY = Histogram('studybot_update_seconds', 'Время обработки обновления Telegram', buckets=LLM_BUCKETS)
+UPDATE_QUEUE_WAIT = Histogram('studybot_update_queue_wait_seconds', 'Время ожидания обновления в очереди', buckets=LLM_BUCKETS)
+UPDATE_QUEUE_DEPTH = Gauge('studybot_update_queue_depth', 'Обновлений в очереди', multiprocess_mode='livesum')
+TELEGRAM_FILE_LATENCY = Histogram('studybot_telegram_file_seconds', 'Получение файла из Telegram', ['operation'])
+OCR_PREPROCESS_LATENCY = Histogram('studybot_ocr_preprocess_seconds', 'Предобработка изображения', ['mode'])
+OCR_TESSERACT_LATENCY = Histogram('studybot_ocr_tesseract_seconds', 'Распознавание Tesseract', buckets=LLM_BUCKETS)
+OPENROUTER_LATENCY = Histogram('studybot_openrouter_seconds', 'HTTP-запрос к OpenRouter', ['status', 'stream'], buckets=LLM_BUCKETS)
+TELEGRAM_API_LATENCY = Histogram('studybot_telegram_api_seconds', 'Вызов Telegram Bot API', ['method', 'status'])
+IN_FLIGHT = Gauge('studybot_in_flight', 'Выполняемые сейчас задачи по этапам', ['stage'], multiprocess_mode='livesum')
+CACHE_REQUESTS = Counter('studybot_cache_requests_total', 'Обращения к кэшам', ['cache', 'result'])
+ERRORS = Counter('studybot_errors_total', 'Ошибки по типам', ['type'])
+LLM_MODEL_LATENCY = Histogram('studybot_llm_model_seconds', 'Ответ модели: полный или до первого токена для потока', ['model', 'kind', 'result'], buckets=LLM_BUCKETS)
+LOAD_LEVEL = Gauge('studybot_load_level', 'Уровень деградации: 0 normal, 1 reduced, 2 cache_only, 3 shed', multiprocess_mode='livemax')
+LOAD_TRANSITIONS = Counter('studybot_load_transitions_total', 'Переходы между уровнями деградации', ['from_level', 'to_level'])
+LLM_ROUTING = Counter('studybot_llm_routing_total', 'События маршрутизации: hedge, hedge_win, fallback', ['event'])
+DEDUPLICATED = Counter('studybot_deduplicated_total', 'Отброшенные повторы: update - обновления, prompt - запросы к ИИ, outbound - вызовы Bot API', ['kind'])
+OUTBOUND_PENDING = Gauge('studybot_telegram_outbound_pending', 'Вызовов Bot API в очереди отправки', multiprocess_mode='livesum')
+
+# Общая сессия для прямых запросов к серверам Telegram (скачивание файлов и Bot API)
+telegram_session = requests.Session()
+telegram_session.mount('https://', HTTPAdapter(pool_maxsize=max(UPDATE_WORKERS, TELEGRAM_SENDERS)))
+
+def send_telegram_request(method, url, **kwargs):
+    """Отправляет запросы telebot через общую сессию и замеряет время по методам API"""
+    api_method = url.rsplit('/', 1)[-1]
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = telegram_session.request(method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        TELEGRAM_API_LATENCY.labels(api_method, status).observe(time.perf_counter() - start)
 
-# Проверка доступности Tesseract
-try:
-    tesseract_version = pytesseract.get_tesseract_version()
-    logger.info(f"Tesseract version: {tesseract_version}")
-except Exception as e:
-    logger.error(f"Tesseract check failed: {str(e)}")
-    raise
+telebot.apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request
+
+# Другой адрес Bot API: локальный telegram-bot-api или заменитель из benchmark/stubs.py
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = f"{TELEGRAM_API_URL}/bot{{0}}/{{1}}"
+    telebot.apihelper.FILE_URL = f"{TELEGRAM_API_URL}/file/bot{{0}}/{{1}}"
+    telegram_session.mount('http://', HTTPAdapter(pool_maxsize=max(UPDATE_WORKERS, TELEGRAM_SENDERS)))
+logger.info("Бот инициализирован")
 
 # OpenRouter API настройки
 OPENROUTER_HEADERS = {
@@ -49,9 +146,413 @@ OPENROUTER_HEADERS = {
     "X-Title": "StudyBot",
     "Content-Type": "application/json"
 }
+OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
+OPENROUTER_MODEL = os.environ.get('OPENROUTER_MODEL', 'qwen/qwen2.5-72b-chat')
+OPENROUTER_CONNECT_TIMEOUT = float(os.environ.get('OPENROUTER_CONNECT_TIMEOUT', 5))
+OPENROUTER_READ_TIMEOUT = float(os.environ.get('OPENROUTER_READ_TIMEOUT', 60))
+OPENROUTER_MAX_RETRIES = int(os.environ.get('OPENROUTER_MAX_RETRIES', 3))
+OPENROUTER_MAX_BACKOFF = float(os.environ.get('OPENROUTER_MAX_BACKOFF', 10))
+OPENROUTER_POOL_SIZE = int(os.environ.get('OPENROUTER_POOL_SIZE', LLM_CONCURRENCY))
+OPENROUTER_BREAKER_THRESHOLD = int(os.environ.get('OPENROUTER_BREAKER_THRESHOLD', 5))
+OPENROUTER_BREAKER_RESET = float(os.environ.get('OPENROUTER_BREAKER_RESET', 30))
+
+# Маршрутизация по моделям: основная и запасные по порядку, быстрая модель
+# для коротких вопросов. Если основная модель не ответила за p95 своих
+# недавних задержек, параллельно отправляется запрос следующей (hedging)
+OPENROUTER_MODELS = [m.strip() for m in os.environ.get('OPENROUTER_MODELS', OPENROUTER_MODEL).split(',') if m.strip()]
+OPENROUTER_FAST_MODEL = os.environ.get('OPENROUTER_FAST_MODEL', '')
+OPENROUTER_FAST_PROMPT_CHARS = int(os.environ.get('OPENROUTER_FAST_PROMPT_CHARS', 200))
+OPENROUTER_HEDGE = os.environ.get('OPENROUTER_HEDGE', '1') == '1'
+OPENROUTER_HEDGE_MIN_DELAY = float(os.environ.get('OPENROUTER_HEDGE_MIN_DELAY', 2))
+OPENROUTER_HEDGE_MAX_DELAY = float(os.environ.get('OPENROUTER_HEDGE_MAX_DELAY', 20))
+# Без потока ответ целиком идет 20-60 секунд; пока нет статистики модели,
+# такие запросы не дублируются
+OPENROUTER_HEDGE_MAX_FULL_DELAY = float(os.environ.get('OPENROUTER_HEDGE_MAX_FULL_DELAY', 120))
+OPENROUTER_STATS_WINDOW = int(os.environ.get('OPENROUTER_STATS_WINDOW', 100))
+
+# Локальные данные: кэши и история
+DATA_DIR = os.environ.get('DATA_DIR', 'data')
+ANSWER_CACHE_DB = os.environ.get('ANSWER_CACHE_DB', os.path.join(DATA_DIR, 'answers.sqlite3'))
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', 7 * 24 * 3600))
+ANSWER_CACHE_MEMORY_ENTRIES = int(os.environ.get('ANSWER_CACHE_MEMORY_ENTRIES', 1000))
+ANSWER_CACHE_MAX_BYTES = int(os.environ.get('ANSWER_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+OCR_CACHE_DB = os.environ.get('OCR_CACHE_DB', os.path.join(DATA_DIR, 'ocr.sqlite3'))  # пустая строка - только в памяти
+OCR_CACHE_ENTRIES = int(os.environ.get('OCR_CACHE_ENTRIES', 2000))
+OCR_CACHE_MAX_BYTES = int(os.environ.get('OCR_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+OCR_CACHE_DISK_MAX_BYTES = int(os.environ.get('OCR_CACHE_DISK_MAX_BYTES', 64 * 1024 * 1024))
+# Допуск в битах 256-битного хэша для похожих фото тех же размеров. Страницы
+# текста с похожей версткой отличаются всего на 10-20 бит, поэтому по
+# умолчанию совпадение только точное
+OCR_CACHE_HASH_DISTANCE = int(os.environ.get('OCR_CACHE_HASH_DISTANCE', 0))
+
+# История запросов: sqlite - общий файл для всех процессов, memory - только в памяти
+HISTORY_BACKEND = os.environ.get('HISTORY_BACKEND', 'sqlite')
+HISTORY_DB = os.environ.get('HISTORY_DB', os.path.join(DATA_DIR, 'history.sqlite3'))
+HISTORY_PER_CHAT = 10
+# Лимит памяти истории для HISTORY_BACKEND=memory; sqlite читает историю из файла
+HISTORY_MEMORY_BYTES = int(os.environ.get('HISTORY_MEMORY_BYTES', 32 * 1024 * 1024))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 2))
+
+# Повторные доставки одного update_id от Telegram отбрасываются в течение окна;
+# SQLite-файл делает проверку общей для всех процессов (пустая строка - только в памяти)
+UPDATE_DEDUP_DB = os.environ.get('UPDATE_DEDUP_DB', os.path.join(DATA_DIR, 'updates.sqlite3'))
+UPDATE_DEDUP_WINDOW = int(os.environ.get('UPDATE_DEDUP_WINDOW', 3600))
+UPDATE_DEDUP_ENTRIES = int(os.environ.get('UPDATE_DEDUP_ENTRIES', 10000))
+
+# Ожидаемый следующий шаг диалога (например, текст после "Задать вопрос"):
+# следующее сообщение чата может попасть в другой процесс gunicorn, поэтому
+# шаги хранятся в общем SQLite-файле (пустая строка - только в памяти процесса)
+STEP_DB = os.environ.get('STEP_DB', os.path.join(DATA_DIR, 'steps.sqlite3'))
+STEP_TTL = int(os.environ.get('STEP_TTL', 3600))
+
+# Блокировка, определяющая единственный процесс, который настраивает вебхук
+LEADER_LOCK_FILE = os.environ.get('LEADER_LOCK_FILE', os.path.join(DATA_DIR, 'leader.lock'))
+leader_lock_file = None
+
+# Запуск: background - проверки и прогрев в фоне, blocking - до начала работы
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'background')
+STARTUP_TIMEOUT = int(os.environ.get('STARTUP_TIMEOUT', 5))
+STARTUP_READY_DEADLINE = float(os.environ.get('STARTUP_READY_DEADLINE', 30))
+MODELS_CACHE_FILE = os.environ.get('MODELS_CACHE_FILE', os.path.join(DATA_DIR, 'models.json'))
+MODELS_CACHE_TTL = int(os.environ.get('MODELS_CACHE_TTL', 6 * 3600))
+readiness = {'ocr': threading.Event(), 'llm': threading.Event()}
+
+# OCR: pool - долгоживущие процессы ocr_worker.py, pytesseract - процесс на каждое фото
+OCR_ENGINE = os.environ.get('OCR_ENGINE', 'pool')
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', OCR_CONCURRENCY))
+OCR_JOB_TIMEOUT = float(os.environ.get('OCR_JOB_TIMEOUT', 30))
+OCR_WORKER_MAX_JOBS = int(os.environ.get('OCR_WORKER_MAX_JOBS', 200))
+OCR_WORKER_START_TIMEOUT = float(os.environ.get('OCR_WORKER_START_TIMEOUT', 20))
+OCR_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocr_worker.py')
+OCR_LANG = 'rus+eng'
+OCR_PSM = 6
+OCR_OEM = 3
+OCR_CONFIG = f'--oem {OCR_OEM} --psm {OCR_PSM} -l {OCR_LANG}'
+# Выбор варианта фото: сначала наименьший с такой длинной стороной,
+# больший - только если текста мало или уверенность OCR низкая
+OCR_MIN_LONG_SIDE = int(os.environ.get('OCR_MIN_LONG_SIDE', 1280))
+OCR_MIN_TEXT_LENGTH = int(os.environ.get('OCR_MIN_TEXT_LENGTH', 20))
+OCR_MIN_CONFIDENCE = int(os.environ.get('OCR_MIN_CONFIDENCE', 60))
+OCR_MAX_DOWNLOAD_BYTES = int(os.environ.get('OCR_MAX_DOWNLOAD_BYTES', 20 * 1024 * 1024))
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+# Альбомы: фото с общим media_group_id собираются, пока после последнего не
+# пройдет ALBUM_WINDOW секунд. Общий SQLite-файл нужен, когда фото альбома
+# попадают в разные процессы gunicorn (пустая строка - только в памяти)
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', 1.5))
+ALBUM_DB = os.environ.get('ALBUM_DB', os.path.join(DATA_DIR, 'albums.sqlite3'))
+# Предобработка: legacy, fast, adaptive (Sauvola) или deskew (Sauvola + выравнивание)
+OCR_PREPROCESS = os.environ.get('OCR_PREPROCESS', 'fast')
+OCR_TARGET_DPI = int(os.environ.get('OCR_TARGET_DPI', 200))
+if OCR_PREPROCESS not in PREPROCESS_MODES:
+    raise ValueError(f"OCR_PREPROCESS должен быть одним из: {', '.join(PREPROCESS_MODES)}")
+
+# Потоковый вывод ответа ИИ с правкой сообщения в Telegram
+LLM_STREAMING = os.environ.get('LLM_STREAMING', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', 1.5))
+STREAM_MIN_CHARS = int(os.environ.get('STREAM_MIN_CHARS', 40))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+SYSTEM_PROMPT = "Ты полезный помощник для студентов и школьников. Отвечай четко, по делу и на русском языке. Если не знаешь точного ответа, скажи об этом."
+
+class StageLimiter:
+    """Ограничивает число одновременных задач одного типа (OCR, LLM) и собирает статистику ожидания"""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._gauge = IN_FLIGHT.labels(name)
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __enter__(self):
+        start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        self._semaphore.acquire()
+        waited = time.monotonic() - start
+        with self._lock:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        self._gauge.inc()
+        if waited > 1:
+            logger.info(f"Задача {self.name} ждала слот {waited:.2f} секунд")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def try_acquire(self):
+        """Занимает слот, если он свободен прямо сейчас; освобождать через release"""
+        if not self._semaphore.acquire(blocking=False):
+            return False
+        with self._lock:
+            self.in_flight += 1
+        self._gauge.inc()
+        return True
+
+    def release(self):
+        self._gauge.dec()
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self._semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            started = self.completed + self.in_flight
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "avg_wait": round(self.total_wait / started, 4) if started else 0.0,
+                "max_wait": round(self.max_wait, 4)
+            }
+
+class UpdateWorkerPool:
+    """Очередь входящих обновлений Telegram и пул потоков, который ее разбирает"""
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.closing = False
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        """Запускает потоки-обработчики"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Запущен пул обработки обновлений: {self.workers} потоков, очередь {self._queue.maxsize}")
 
-# Хранение истории
-user_history = {}
+    def submit(self, update):
+        """Ставит обновление в очередь, возвращает False если очередь переполнена или пул останавливается"""
+        if self.closing:
+            with self._lock:
+                self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait((update, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        UPDATE_QUEUE_DEPTH.inc()
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def shutdown(self, timeout):
+        """Перестает принимать обновления и ждет обработки уже принятых
+
+        Принятые обновления Telegram уже подтверждены и повторно не придут,
+        поэтому процесс не должен завершаться, пока они в очереди.
+        """
+        self.closing = True
+        pending = self._queue.unfinished_tasks
+        if pending:
+            logger.info(f"Остановка: дообрабатываем {pending} обновлений")
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"Остановка: не успели обработать {self._queue.unfinished_tasks} обновлений")
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            update, enqueued_at = self._queue.get()
+            UPDATE_QUEUE_DEPTH.dec()
+            waited = time.monotonic() - enqueued_at
+            UPDATE_QUEUE_WAIT.observe(waited)
+            with self._lock:
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            try:
+                with UPDATE_LATENCY.time(), IN_FLIGHT.labels('update').track_inprogress():
+                    bot.process_new_updates([update])
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {str(e)}")
+                ERRORS.labels('update').inc()
+                with self._lock:
+                    self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            done = self.processed + self.failed
+            return {
+                "workers": self.workers,
+                "queue_depth": self._queue.qsize(),
+                "queue_max_depth": self.max_depth,
+                "queue_capacity": self._queue.maxsize,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+                "avg_wait": round(self.total_wait / done, 4) if done else 0.0,
+                "max_wait": round(self.max_wait, 4)
+            }
+
+ocr_limiter = StageLimiter('ocr', OCR_CONCURRENCY)
+llm_limiter = StageLimiter('llm', LLM_CONCURRENCY)
+update_pool = UpdateWorkerPool(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+class AdmissionController:
+    """Переключает уровни деградации по нагрузке
+
+    normal - обычная работа; reduced - OCR с меньшим разрешением и без
+    повторов на больших вариантах фото, обрезанный текст для ИИ и меньший
+    max_tokens; cache_only - ИИ отвечает только из кэша; shed - вопросы и фото
+    сразу получают просьбу повторить позже. Повышение уровня происходит сразу,
+    понижение - на один шаг после ADMISSION_COOLDOWN секунд спокойствия.
+    """
+
+    LEVELS = ('normal', 'reduced', 'cache_only', 'shed')
+    NORMAL, REDUCED, CACHE_ONLY, SHED = range(4)
+
+    def __init__(self, enabled, queue_levels, ocr_levels, llm_levels, interval, cooldown):
+        self.enabled = enabled
+        self.queue_levels = queue_levels
+        self.ocr_levels = ocr_levels
+        self.llm_levels = llm_levels
+        self.interval = interval
+        self.cooldown = cooldown
+        self.level = self.NORMAL
+        self._calm_since = None
+        self._llm_waits = deque()
+        self._lock = threading.Lock()
+        self.transitions = 0
+        self.shed = 0
+        self.inputs = {}
+
+    def start(self):
+        if not self.enabled:
+            return
+        threading.Thread(target=self._run, name="admission", daemon=True).start()
+
+    def observe_llm_wait(self, seconds):
+        """Учитывает ожидание слота llm_limiter за последнюю минуту"""
+        now = time.monotonic()
+        with self._lock:
+            self._llm_waits.append((now, seconds))
+            while self._llm_waits and now - self._llm_waits[0][0] > 60:
+                self._llm_waits.popleft()
+
+    def _llm_wait_p95(self):
+        with self._lock:
+            values = sorted(seconds for _, seconds in self._llm_waits)
+        if len(values) < 5:
+            return 0.0
+        return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+    @staticmethod
+    def _grade(value, thresholds):
+        return sum(1 for threshold in thresholds if value >= threshold)
+
+    def evaluate(self):
+        """Пересчитывает уровень по текущим показателям"""
+        ocr = ocr_limiter.stats()
+        self.inputs = {
+            "queue_fill": round(update_pool.depth() / max(1, UPDATE_QUEUE_SIZE), 3),
+            "ocr_per_slot": round((ocr["in_flight"] + ocr["waiting"]) / max(1, ocr["limit"]), 2),
+            "llm_wait_p95": round(self._llm_wait_p95(), 2)
+        }
+        target = max(
+            self._grade(self.inputs["queue_fill"], self.queue_levels),
+            self._grade(self.inputs["ocr_per_slot"], self.ocr_levels),
+            self._grade(self.inputs["llm_wait_p95"], self.llm_levels)
+        )
+        now = time.monotonic()
+        if target > self.level:
+            self._switch(target)
+            self._calm_since = None
+        elif target < self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.cooldown:
+                self._switch(self.level - 1)
+                self._calm_since = now
+        else:
+            self._calm_since = None
+
+    def _switch(self, level):
+        previous = self.level
+        self.level = level
+        self.transitions += 1
+        LOAD_LEVEL.set(level)
+        LOAD_TRANSITIONS.labels(self.LEVELS[previous], self.LEVELS[level]).inc()
+        log = logger.warning if level > previous else logger.info
+        log(f"Уровень нагрузки: {self.LEVELS[previous]} -> {self.LEVELS[level]} ({self.inputs})")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.evaluate()
+            except Exception as e:
+                logger.error(f"Ошибка оценки нагрузки: {str(e)}")
+
+    def reduced(self):
+        return self.level >= self.REDUCED
+
+    def cache_only(self):
+        return self.level >= self.CACHE_ONLY
+
+    def should_shed(self):
+        if self.level < self.SHED:
+            return False
+        with self._lock:
+            self.shed += 1
+        ERRORS.labels('shed').inc()
+        return True
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "level": self.LEVELS[self.level],
+            "inputs": self.inputs,
+            "transitions": self.transitions,
+            "shed": self.shed
+        }
+
+admission = AdmissionController(
+    enabled=ADMISSION_ENABLED,
+    queue_levels=ADMISSION_QUEUE_LEVELS,
+    ocr_levels=ADMISSION_OCR_LEVELS,
+    llm_levels=ADMISSION_LLM_LEVELS,
+    interval=ADMISSION_INTERVAL,
+    cooldown=ADMISSION_COOLDOWN
+)
+
+BUSY_MESSAGE = "⏳ Сейчас слишком много запросов. Пожалуйста, повторите через минуту."
 
 def create_menu():
     """Создает клавиатуру с основными кнопками"""
@@ -61,22 +562,193 @@ def create_menu():
     markup.add(KeyboardButton('ℹ️ Помощь'))
     return markup
 
-def query_openrouter_api(prompt):
-    """Отправляет запрос в OpenRouter API с использованием Qwen 2.5"""
-    try:
-        logger.info(f"Запрос к OpenRouter API: {prompt[:100]}...")
-        
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        
-        # Используем корректный идентификатор Qwen 2.5
-        model_id = "qwen/qwen2.5-72b-chat"
-        
-        payload = {
-            "model": model_id,
+class CircuitOpenError(Exception):
+    """Запрос не выполнен, потому что автомат защиты разомкнут"""
+
+class CircuitBreaker:
+    """Автомат защиты: после серии сбоев временно отклоняет запросы к внешнему сервису"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли сейчас отправить запрос"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                logger.info(f"Автомат {self.name}: пробный запрос после паузы")
+            # В полуоткрытом состоянии пропускаем только один пробный запрос
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Автомат {self.name}: сервис восстановлен")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Автомат {self.name} разомкнут после {self.failures} сбоев")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+# Ответ, когда автомат защиты модели разомкнут и запрос не отправлялся
+CIRCUIT_OPEN_ANSWER = "⚠️ ИИ-сервис временно недоступен. Попробуйте через минуту."
+
+class StreamCancelled(Exception):
+    """Потоковый ответ больше не нужен: первой ответила другая модель"""
+
+class OpenRouterClient:
+    """Клиент OpenRouter API с пулом соединений, повторами и автоматами защиты
+
+    У каждой модели свой автомат: сбои одной модели не должны отклонять
+    запросы к запасным.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, headers, model, connect_timeout, read_timeout,
+                 max_retries, max_backoff, pool_size, breaker_threshold, breaker_reset):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        # Держим соединения открытыми, чтобы не платить за TCP+TLS на каждый вопрос
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _retry_after(self, response):
+        """Возвращает задержку из заголовка Retry-After в секундах"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _backoff(self, attempt, retry_after=None):
+        """Экспоненциальная задержка со случайным разбросом"""
+        delay = min(self.max_backoff, 0.5 * (2 ** attempt))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _send(self, method, url, **kwargs):
+        """Один HTTP-запрос с замером времени по коду ответа"""
+        stream = 'true' if kwargs.get('stream') else 'false'
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            OPENROUTER_LATENCY.labels(type(e).__name__, stream).observe(time.perf_counter() - start)
+            ERRORS.labels(f"openrouter_{type(e).__name__}").inc()
+            raise
+        OPENROUTER_LATENCY.labels(str(response.status_code), stream).observe(time.perf_counter() - start)
+        return response
+
+    def breaker(self, model=None):
+        """Автомат защиты модели; запросы не к модели (список моделей) идут через общий"""
+        name = f"openrouter:{model}" if model else 'openrouter'
+        with self._breakers_lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, self.breaker_threshold, self.breaker_reset)
+            return breaker
+
+    def request(self, method, path, model=None, **kwargs):
+        """Выполняет запрос с повторами; при разомкнутом автомате модели бросает CircuitOpenError"""
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            ERRORS.labels('openrouter_circuit_open').inc()
+            raise CircuitOpenError(breaker.name)
+
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, url, **kwargs)
+            except requests.exceptions.ReadTimeout:
+                # Медленный ответ не повторяем: это только удвоит ожидание пользователя
+                breaker.record_failure()
+                raise
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.max_retries:
+                    breaker.record_failure()
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Ошибка соединения с OpenRouter, повтор через {delay:.1f} с")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except requests.exceptions.RequestException:
+                breaker.record_failure()
+                raise
+
+            if response.status_code not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                break
+            retry_after = self._retry_after(response)
+            if retry_after is not None and retry_after > self.max_backoff:
+                # Ждать так долго в воркере нельзя, сразу отдаем ошибку
+                break
+            delay = self._backoff(attempt, retry_after)
+            logger.warning(f"OpenRouter ответил {response.status_code}, повтор через {delay:.1f} с")
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def build_payload(self, prompt, model=None):
+        return {
+            "model": model or self.model,
             "messages": [
                 {
                     "role": "system",
-                    "content": "Ты полезный помощник для студентов и школьников. Отвечай четко, по делу и на русском языке. Если не знаешь точного ответа, скажи об этом."
+                    "content": SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
@@ -84,113 +756,2149 @@ def query_openrouter_api(prompt):
                 }
             ],
             "temperature": 0.7,
-            "max_tokens": 2000,
+            # При перегрузке ответы короче, чтобы быстрее освобождать слоты
+            "max_tokens": ADMISSION_MAX_TOKENS if admission.reduced() else 2000,
             "frequency_penalty": 0.2,
             "presence_penalty": 0.2
         }
-        
-        response = requests.post(url, headers=OPENROUTER_HEADERS, json=payload, timeout=60)
-        logger.info(f"OpenRouter API status: {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            answer = data['choices'][0]['message']['content'].strip()
-            logger.info(f"Получен ответ от OpenRouter API: {len(answer)} символов")
+
+    def chat(self, prompt, model=None):
+        """Возвращает ответ модели или текст ошибки для пользователя"""
+        try:
+            payload = self.build_payload(prompt, model)
+            response = self.request('POST', '/chat/completions', model=payload["model"], json=payload)
+            logger.info(f"OpenRouter API status: {response.status_code}")
+
+            if response.status_code == 200:
+                data = response.json()
+                answer = data['choices'][0]['message']['content'].strip()
+                logger.info(f"Получен ответ от OpenRouter API: {len(answer)} символов")
+                return answer
+            return self.describe_error(response)
+
+        except CircuitOpenError as e:
+            logger.warning(f"Запрос отклонен автоматом защиты {str(e)}")
+            return CIRCUIT_OPEN_ANSWER
+        except requests.exceptions.Timeout:
+            logger.error("Таймаут при запросе к OpenRouter API")
+            return "⌛ Таймаут соединения с ИИ-сервисом"
+        except requests.exceptions.ConnectionError:
+            logger.error("Ошибка подключения к OpenRouter API")
+            return "🔌 Ошибка подключения к ИИ-сервису"
+        except Exception as e:
+            logger.error(f"Ошибка запроса к OpenRouter API: {str(e)}")
+            return f"⚠️ Непредвиденная ошибка: {str(e)}"
+
+    def chat_stream(self, prompt, on_delta, model=None):
+        """Запрашивает ответ в режиме SSE, передавая накопленный текст в on_delta
+
+        Если on_delta бросает StreamCancelled, соединение закрывается и
+        исключение передается вызывающему.
+        """
+        try:
+            payload = self.build_payload(prompt, model)
+            payload["stream"] = True
+            response = self.request('POST', '/chat/completions', model=payload["model"], json=payload, stream=True)
+            logger.info(f"OpenRouter API status: {response.status_code}")
+            if response.status_code != 200:
+                return self.describe_error(response)
+
+            parts = []
+            with response:
+                for line in response.iter_lines():
+                    # Пустые строки разделяют события, строки с ':' - служебные комментарии
+                    if not line or line.startswith(b':'):
+                        continue
+                    if not line.startswith(b'data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == b'[DONE]':
+                        break
+                    event = json.loads(data)
+                    if 'error' in event:
+                        error_message = event['error'].get('message', 'Без описания')
+                        logger.error(f"OpenRouter API stream error: {error_message}")
+                        return f"❌ Ошибка ИИ во время ответа: {error_message}"
+                    choices = event.get('choices') or [{}]
+                    delta = (choices[0].get('delta') or {}).get('content')
+                    if delta:
+                        parts.append(delta)
+                        on_delta(''.join(parts))
+
+            answer = ''.join(parts).strip()
+            logger.info(f"Получен потоковый ответ от OpenRouter API: {len(answer)} символов")
+            if not answer:
+                return "❌ ИИ вернул пустой ответ"
             return answer
+
+        except CircuitOpenError as e:
+            logger.warning(f"Запрос отклонен автоматом защиты {str(e)}")
+            return CIRCUIT_OPEN_ANSWER
+        except requests.exceptions.Timeout:
+            logger.error("Таймаут при потоковом запросе к OpenRouter API")
+            return "⌛ Таймаут соединения с ИИ-сервисом"
+        except requests.exceptions.ConnectionError:
+            logger.error("Ошибка подключения к OpenRouter API")
+            return "🔌 Ошибка подключения к ИИ-сервису"
+        except StreamCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка потокового запроса к OpenRouter API: {str(e)}")
+            return f"⚠️ Непредвиденная ошибка: {str(e)}"
+
+    def warm_up(self, timeout):
+        """Открывает соединение в пуле сессии; True, если сервер ответил"""
+        response = self.session.get(f"{self.base_url}/auth/key", timeout=(timeout, timeout))
+        response.close()
+        return True
+
+    def describe_error(self, response):
+        """Формирует понятное сообщение об ошибке по ответу API"""
+        try:
+            error_data = response.json()
+            error_info = error_data.get('error', {})
+            error_code = error_info.get('code', 'UNKNOWN')
+            error_message = error_info.get('message', 'Без описания')
+
+            logger.error(f"OpenRouter API error {response.status_code}: [{error_code}] {error_message}")
+            ERRORS.labels(f"openrouter_http_{response.status_code}").inc()
+
+            if response.status_code == 400:
+                return f"❌ Ошибка запроса к ИИ: {error_message}"
+            elif response.status_code == 401:
+                return "❌ Ошибка авторизации OpenRouter API. Проверьте токен."
+            elif response.status_code == 403:
+                return "❌ Доступ к OpenRouter API запрещен. Проверьте токен и ограничения."
+            elif response.status_code == 429:
+                return "⏰ Превышен лимит запросов к OpenRouter API. Попробуйте позже."
+            else:
+                return f"❌ Ошибка OpenRouter API: {response.status_code} - {error_code}"
+        except json.JSONDecodeError:
+            logger.error(f"OpenRouter API вернул невалидный JSON: {response.text[:200]}")
+            return f"❌ Ошибка OpenRouter API: {response.status_code}"
+
+    def list_models(self, timeout=15):
+        """Возвращает список идентификаторов доступных моделей"""
+        response = self.request('GET', '/models', timeout=(self.timeout[0], timeout))
+        if response.status_code != 200:
+            raise RuntimeError(f"Ошибка получения списка моделей: {response.status_code}")
+        return [m['id'] for m in response.json().get('data', [])]
+
+openrouter_client = OpenRouterClient(
+    base_url=OPENROUTER_BASE_URL,
+    headers=OPENROUTER_HEADERS,
+    model=OPENROUTER_MODEL,
+    connect_timeout=OPENROUTER_CONNECT_TIMEOUT,
+    read_timeout=OPENROUTER_READ_TIMEOUT,
+    max_retries=OPENROUTER_MAX_RETRIES,
+    max_backoff=OPENROUTER_MAX_BACKOFF,
+    pool_size=OPENROUTER_POOL_SIZE,
+    breaker_threshold=OPENROUTER_BREAKER_THRESHOLD,
+    breaker_reset=OPENROUTER_BREAKER_RESET
+)
+
+class ModelStats:
+    """Скользящая статистика задержек и ошибок одной модели"""
+
+    def __init__(self, window):
+        self.latencies = {'full': deque(maxlen=window), 'first_token': deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.available = True
+
+    def observe(self, kind, seconds, ok):
+        self.requests += 1
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies[kind].append(seconds)
         else:
-            # Детальный анализ ошибки
+            self.errors += 1
+
+    def quantile(self, kind, q):
+        values = sorted(self.latencies[kind])
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+class ModelRouter:
+    """Выбирает модель для вопроса и дублирует медленные запросы на запасную модель
+
+    Короткие вопросы идут в быструю модель, остальные - в модели по порядку
+    OPENROUTER_MODELS; недоступные и часто ошибающиеся модели уходят в конец.
+    Если модель не ответила (для потока - не прислала первый токен) за p95
+    своих недавних задержек, параллельно запускается следующая, и
+    используется ответ, пришедший первым. Ошибка до первого токена сразу
+    передает вопрос следующей модели.
+
+    Запасной запрос занимает еще один слот limiter и только если слот
+    свободен; слот освобождается, когда закончатся все запросы вопроса.
+    """
+
+    def __init__(self, client, models, fast_model, fast_prompt_chars, hedge, hedge_min_delay, hedge_max_delay,
+                 window, hedge_max_full_delay=None, limiter=None):
+        self.client = client
+        self.models = models
+        self.fast_model = fast_model
+        self.fast_prompt_chars = fast_prompt_chars
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_max_full_delay = hedge_max_full_delay or hedge_max_delay
+        self.limiter = limiter
+        self._stats = {model: ModelStats(window) for model in dict.fromkeys(models + [fast_model]) if model}
+        self._lock = threading.Lock()
+        # Запасной запрос занимает поток, пока не закончится, даже если уже не нужен
+        self._executor = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY * 2, thread_name_prefix='llm')
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    def candidates(self, prompt):
+        """Модели для вопроса в порядке попыток"""
+        models = list(self.models)
+        if self.fast_model and len(prompt) <= self.fast_prompt_chars:
+            models = [self.fast_model] + [m for m in models if m != self.fast_model]
+        with self._lock:
+            healthy = [m for m in models if self._stats[m].available and not self._unreliable(m)]
+        # Остальные модели остаются последней надеждой
+        return healthy + [m for m in models if m not in healthy]
+
+    def _unreliable(self, model):
+        stats = self._stats[model]
+        return len(stats.outcomes) >= 5 and stats.error_rate() > 0.5
+
+    def hedge_delay(self, model, kind):
+        """Сколько ждать ответа модели, прежде чем дублировать запрос; None - не дублировать
+
+        Время полного ответа зависит от его длины, поэтому без статистики
+        модели такой запрос не дублируется.
+        """
+        with self._lock:
+            stats = self._stats[model]
+            p95 = stats.quantile(kind, 0.95) if len(stats.latencies[kind]) >= 10 else None
+        if kind == 'full':
+            if p95 is None:
+                return None
+            return min(self.hedge_max_full_delay, max(self.hedge_min_delay, p95))
+        if p95 is None:
+            return self.hedge_max_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, p95))
+
+    def set_available(self, available_models):
+        """Отмечает модели, которых нет в списке OpenRouter"""
+        with self._lock:
+            for model, stats in self._stats.items():
+                stats.available = model in available_models
+
+    def _record(self, model, kind, seconds, ok):
+        LLM_MODEL_LATENCY.labels(model, kind, 'ok' if ok else 'error').observe(seconds)
+        with self._lock:
+            self._stats[model].observe(kind, seconds, ok)
+
+    def chat(self, prompt):
+        return self._route(prompt, None)
+
+    def chat_stream(self, prompt, on_delta):
+        return self._route(prompt, on_delta)
+
+    def _route(self, prompt, on_delta):
+        models = self.candidates(prompt)
+        kind = 'full' if on_delta is None else 'first_token'
+        lock = threading.Lock()
+        winner = []
+
+        def run(model):
+            start = time.monotonic()
+            if on_delta is None:
+                answer = self.client.chat(prompt, model)
+                if answer != CIRCUIT_OPEN_ANSWER:
+                    # Отклоненный автоматом запрос модель не видела
+                    self._record(model, kind, time.monotonic() - start, not is_error_answer(answer))
+                return answer
+
+            def forward(text):
+                with lock:
+                    if not winner:
+                        winner.append(model)
+                        self._record(model, kind, time.monotonic() - start, True)
+                    elif winner[0] != model:
+                        raise StreamCancelled()
+                on_delta(text)
+
             try:
-                error_data = response.json()
-                error_info = error_data.get('error', {})
-                error_code = error_info.get('code', 'UNKNOWN')
-                error_message = error_info.get('message', 'Без описания')
-                
-                logger.error(f"OpenRouter API error {response.status_code}: [{error_code}] {error_message}")
-                
-                # Формируем понятное сообщение об ошибке
-                if response.status_code == 400:
-                    return f"❌ Ошибка запроса к ИИ: {error_message}"
-                elif response.status_code == 401:
-                    return "❌ Ошибка авторизации OpenRouter API. Проверьте токен."
-                elif response.status_code == 403:
-                    return "❌ Доступ к OpenRouter API запрещен. Проверьте токен и ограничения."
-                elif response.status_code == 429:
-                    return "⏰ Превышен лимит запросов к OpenRouter API. Попробуйте позже."
+                answer = self.client.chat_stream(prompt, forward, model)
+            except StreamCancelled:
+                logger.info(f"Потоковый ответ {model} отменен: первой ответила другая модель")
+                return None
+            with lock:
+                if not winner and answer != CIRCUIT_OPEN_ANSWER:
+                    # Ответ закончился, не начавшись: ошибка до первого токена
+                    self._record(model, kind, time.monotonic() - start, False)
+            return answer
+
+        running = {}
+        launched = []
+        last_error = None
+        hedged = False
+        hedge_slot = False
+
+        def launch(model):
+            future = self._executor.submit(run, model)
+            running[future] = model
+            launched.append(future)
+            delay = self.hedge_delay(model, kind)
+            return None if delay is None else time.monotonic() + delay
+
+        primary = models.pop(0)
+        deadline = launch(primary)
+        try:
+            while running:
+                if models and self.hedge and not hedged and deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
                 else:
-                    return f"❌ Ошибка OpenRouter API: {response.status_code} - {error_code}"
-            except json.JSONDecodeError:
-                logger.error(f"OpenRouter API вернул невалидный JSON: {response.text[:200]}")
-                return f"❌ Ошибка OpenRouter API: {response.status_code}"
-            
-    except requests.exceptions.Timeout:
-        logger.error("Таймаут при запросе к OpenRouter API")
-        return "⌛ Таймаут соединения с ИИ-сервисом"
-    except requests.exceptions.ConnectionError:
-        logger.error("Ошибка подключения к OpenRouter API")
-        return "🔌 Ошибка подключения к ИИ-сервису"
-    except Exception as e:
-        logger.error(f"Ошибка запроса к OpenRouter API: {str(e)}")
-        return f"⚠️ Непредвиденная ошибка: {str(e)}"
+                    # Дублировать больше нечем: просто ждем ответа
+                    timeout = None
+                if on_delta is not None:
+                    # Для потока ждем первый токен, поэтому проверяем часто
+                    timeout = 0.05 if timeout is None else min(timeout, 0.05)
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                if winner:
+                    # Текст уже показывается пользователю: ждем конца этого потока
+                    model = winner[0]
+                    if model != primary:
+                        self._note('hedge_win')
+                    return next(f for f, m in running.items() if m == model).result()
+                for future in done:
+                    model = running.pop(future)
+                    answer = future.result()
+                    if winner and winner[0] == model:
+                        return answer
+                    if answer is not None and not is_error_answer(answer):
+                        if model != primary:
+                            self._note('hedge_win')
+                        return answer
+                    last_error = answer or last_error
+                    if not running and models:
+                        logger.warning(f"Модель {model} ответила ошибкой, пробуем {models[0]}")
+                        self._note('fallback')
+                        primary = models.pop(0)
+                        deadline = launch(primary)
+                if (running and models and self.hedge and not hedged and deadline is not None
+                        and time.monotonic() >= deadline):
+                    hedged = True
+                    if self.limiter is not None and not self.limiter.try_acquire():
+                        logger.info(f"Модель {primary} отвечает дольше обычного, но свободных слотов ИИ нет")
+                        continue
+                    hedge_slot = self.limiter is not None
+                    logger.info(f"Модель {primary} отвечает дольше обычного, дублируем запрос в {models[0]}")
+                    self._note('hedge')
+                    deadline = launch(models.pop(0))
+            return last_error or "❌ ИИ вернул пустой ответ"
+        finally:
+            if hedge_slot:
+                self._release_when_done(launched)
+
+    def _release_when_done(self, futures):
+        """Освобождает слот запасного запроса, когда закончатся все запросы вопроса"""
+        pending = [f for f in futures if not f.done()]
+        if not pending:
+            self.limiter.release()
+            return
+        remaining = [len(pending)]
+        lock = threading.Lock()
+
+        def on_done(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.limiter.release()
+
+        for future in pending:
+            future.add_done_callback(on_done)
+    def _note(self, event):
+        LLM_ROUTING.labels(event).inc()
+        with self._lock:
+            if event == 'hedge':
+                self.hedges += 1
+            elif event == 'hedge_win':
+                self.hedge_wins += 1
+            else:
+                self.fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model, stats in self._stats.items():
+                models[model] = {
+                    "available": stats.available,
+                    "requests": stats.requests,
+                    "errors": stats.errors,
+                    "error_rate": round(stats.error_rate(), 4),
+                    "p50": stats.quantile('full', 0.5),
+                    "p95": stats.quantile('full', 0.95),
+                    "first_token_p50": stats.quantile('first_token', 0.5),
+                    "first_token_p95": stats.quantile('first_token', 0.95)
+                }
+            return {
+                "models": models,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "fallbacks": self.fallbacks
+            }
+
+model_router = ModelRouter(
+    client=openrouter_client,
+    models=OPENROUTER_MODELS,
+    fast_model=OPENROUTER_FAST_MODEL,
+    fast_prompt_chars=OPENROUTER_FAST_PROMPT_CHARS,
+    hedge=OPENROUTER_HEDGE,
+    hedge_min_delay=OPENROUTER_HEDGE_MIN_DELAY,
+    hedge_max_delay=OPENROUTER_HEDGE_MAX_DELAY,
+    window=OPENROUTER_STATS_WINDOW,
+    hedge_max_full_delay=OPENROUTER_HEDGE_MAX_FULL_DELAY,
+    limiter=llm_limiter
+)
+
+# Префиксы сообщений об ошибках, которые возвращает query_openrouter_api
+ERROR_PREFIXES = ('❌', '⚠️', '⏰', '⌛', '🔌')
+
+def is_error_answer(answer):
+    """Проверяет, что строка - сообщение об ошибке, а не ответ модели"""
+    return not answer or answer.startswith(ERROR_PREFIXES)
+
+def open_sqlite(path):
+    """Открывает SQLite-файл, общий для потоков и процессов"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# Латинские буквы, которые OCR путает с похожими кириллическими
+OCR_CONFUSABLES = str.maketrans('aeopcxyk', 'аеорсхук')
+
+# Кавычки не меняют смысл вопроса, в отличие от знаков операций и цифр
+PROMPT_QUOTES = str.maketrans('', '', '"\'`«»„“”‘’')
+
+def normalize_prompt(prompt):
+    """Приводит вопрос к каноническому виду для ключа кэша
+
+    Знаки + - * / = < > ^ ( ) , . и цифры сохраняются: "3x + 7 = 22" и
+    "3x - 7 = 22" - разные задачи. Убираются только кавычки, лишние пробелы
+    (в том числе вокруг знаков) и ?!. в конце.
+    """
+    text = prompt.lower().replace('ё', 'е')
+    text = text.translate(OCR_CONFUSABLES).translate(PROMPT_QUOTES)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r' ?([+\-*/=<>^(),]) ?', r'\1', text)
+    return text.strip().rstrip('?!. ')
+
+class AnswerCache:
+    """LRU-кэш ответов ИИ в памяти с хранением в SQLite"""
+
+    KEY_VERSION = 2
+
+    def __init__(self, path, ttl, memory_entries, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_trim = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.skipped = 0
+        self._db = None
+        if path:
+            try:
+                self._db = open_sqlite(path)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS answers ("
+                    "key TEXT PRIMARY KEY, answer TEXT NOT NULL, "
+                    "created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers(accessed)")
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось открыть кэш ответов {path}: {str(e)}")
+                self._db = None
+
+    def make_key(self, prompt):
+        normalized = normalize_prompt(prompt)
+        if not normalized:
+            return None
+        # Версия отделяет ключи от записей, сохраненных с прежней нормализацией
+        return hashlib.sha256(f"{self.KEY_VERSION}:{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, prompt):
+        """Возвращает сохраненный ответ или None"""
+        key = self.make_key(prompt)
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                answer, created = entry
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    CACHE_REQUESTS.labels('answer', 'hit').inc()
+                    return answer
+                del self._memory[key]
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT answer, created FROM answers WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row and now - row[1] < self.ttl:
+                        self._db.execute("UPDATE answers SET accessed = ? WHERE key = ?", (now, key))
+                        self._remember(key, row[0], row[1])
+                        self.hits += 1
+                        self.disk_hits += 1
+                        CACHE_REQUESTS.labels('answer', 'disk_hit').inc()
+                        return row[0]
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка чтения кэша ответов: {str(e)}")
+
+            self.misses += 1
+            CACHE_REQUESTS.labels('answer', 'miss').inc()
+            return None
+
+    def put(self, prompt, answer):
+        """Сохраняет ответ; сообщения об ошибках не кэшируются"""
+        if is_error_answer(answer):
+            with self._lock:
+                self.skipped += 1
+            return
+        key = self.make_key(prompt)
+        if key is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, answer, now)
+            self.stores += 1
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers (key, answer, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                    (key, answer, now, now, len(answer.encode('utf-8')))
+                )
+                self._puts_since_trim += 1
+                if self._puts_since_trim >= 50:
+                    self._puts_since_trim = 0
+                    self._trim(now)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка записи кэша ответов: {str(e)}")
+
+    def _remember(self, key, answer, created):
+        self._memory[key] = (answer, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _trim(self, now):
+        """Удаляет устаревшие записи и самые давно использованные сверх лимита размера"""
+        self._db.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        keys = []
+        for key, size in self._db.execute("SELECT key, size FROM answers ORDER BY accessed"):
+            keys.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+        logger.info(f"Кэш ответов: удалено {len(keys)} записей ({freed} байт)")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries_in_memory": len(self._memory),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "skipped_errors": self.skipped
+            }
+
+answer_cache = AnswerCache(
+    path=ANSWER_CACHE_DB,
+    ttl=ANSWER_CACHE_TTL,
+    memory_entries=ANSWER_CACHE_MEMORY_ENTRIES,
+    max_bytes=ANSWER_CACHE_MAX_BYTES
+)
+
+class FlightCall:
+    """Выполняемый вызов SingleFlight и его результат"""
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Объединяет одинаковые одновременные вызовы: функция выполняется один раз,
+    остальные вызывающие ждут и получают тот же результат"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = FlightCall()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not leader:
+            DEDUPLICATED.labels(self.name).inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "shared": self.shared
+            }
+
+prompt_flights = SingleFlight('prompt')
+
+def query_openrouter_api(prompt, on_progress=None):
+    """Отправляет запрос в OpenRouter API через model_router (по умолчанию Qwen 2.5)
+
+    Если передан on_progress и включен LLM_STREAMING, ответ запрашивается
+    потоком и on_progress вызывается с накопленным текстом. Одинаковые
+    вопросы, заданные одновременно, отправляются в API один раз: остальные
+    вызовы ждут готовый ответ без промежуточного вывода.
+    """
+    cached = answer_cache.get(prompt)
+    if cached is not None:
+        logger.info(f"Ответ найден в кэше: {prompt[:100]}...")
+        return cached
+
+    if admission.cache_only():
+        logger.warning(f"Перегрузка: ответа нет в кэше, запрос к ИИ не отправлен: {prompt[:100]}...")
+        return "⚠️ ИИ-сервис сейчас перегружен. Пожалуйста, повторите вопрос через минуту."
+
+    def fetch():
+        logger.info(f"Запрос к OpenRouter API: {prompt[:100]}...")
+        start = time.monotonic()
+        with llm_limiter:
+            admission.observe_llm_wait(time.monotonic() - start)
+            # max_tokens урезается при перегрузке: такой ответ может оборваться
+            degraded = admission.reduced()
+            if on_progress is not None and LLM_STREAMING:
+                answer = model_router.chat_stream(prompt, on_progress)
+            else:
+                answer = model_router.chat(prompt)
+        if degraded:
+            logger.info("Ответ получен при перегрузке и не кэшируется")
+        else:
+            answer_cache.put(prompt, answer)
+        return answer
+
+    key = answer_cache.make_key(prompt)
+    if key is None:
+        return fetch()
+    return prompt_flights.do(key, fetch)
+
+class UpdateDeduplicator:
+    """Помнит update_id, обработанные за последние window секунд
+
+    Telegram повторно доставляет обновление, если не получил ответ на вебхук
+    вовремя. В памяти хранится ограниченный набор недавних id, SQLite-таблица
+    делает проверку общей для процессов gunicorn.
+    """
+
+    def __init__(self, path, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._checks_since_trim = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.released = 0
+        self._db = None
+        if path:
+            try:
+                self._db = open_sqlite(path)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS seen_updates_seen ON seen_updates(seen)")
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось открыть журнал обновлений {path}: {str(e)}")
+                self._db = None
+
+    def register(self, update_id):
+        """Отмечает обновление; возвращает False, если оно уже было получено"""
+        now = time.time()
+        with self._lock:
+            seen = self._seen.get(update_id)
+            if seen is not None and now - seen < self.window:
+                self.duplicates += 1
+                DEDUPLICATED.labels('update').inc()
+                return False
+            first = True
+            if self._db is not None:
+                try:
+                    # Запись старше окна заменяется, иначе INSERT OR IGNORE ничего не вставит
+                    self._db.execute(
+                        "DELETE FROM seen_updates WHERE update_id = ? AND seen < ?", (update_id, now - self.window)
+                    )
+                    first = self._db.execute(
+                        "INSERT OR IGNORE INTO seen_updates (update_id, seen) VALUES (?, ?)", (update_id, now)
+                    ).rowcount == 1
+                    self._checks_since_trim += 1
+                    if self._checks_since_trim >= 500:
+                        self._checks_since_trim = 0
+                        self._db.execute("DELETE FROM seen_updates WHERE seen < ?", (now - self.window,))
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка журнала обновлений: {str(e)}")
+            self._seen[update_id] = now
+            self._seen.move_to_end(update_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            if not first:
+                self.duplicates += 1
+                DEDUPLICATED.labels('update').inc()
+                return False
+            self.accepted += 1
+            return True
+
+    def forget(self, update_id):
+        """Снимает отметку, чтобы повторная доставка была обработана (обновление не принято в работу)"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+            self.released += 1
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка журнала обновлений: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tracked": len(self._seen),
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "released": self.released
+            }
+
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUP_DB, UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_ENTRIES)
+
+class SQLiteStepBackend(HandlerBackend):
+    """Хранилище next step handlers telebot, общее для процессов
+
+    Вместо самой функции сохраняется ее имя в модуле bot, аргументы - в JSON.
+    Обработчики забираются атомарно, поэтому шаг выполнит ровно один процесс.
+    telebot спрашивает шаги для каждого сообщения, поэтому без шагов в чате
+    это одно чтение по индексу, без блокировки на запись.
+    """
+
+    def __init__(self, path, ttl):
+        super().__init__()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = open_sqlite(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS next_steps ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, "
+            "callback TEXT NOT NULL, args TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS next_steps_chat ON next_steps(chat_id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS next_steps_created ON next_steps(created)")
+
+    def register_handler(self, handler_group_id, handler):
+        data = json.dumps({"args": list(handler.args), "kwargs": handler.kwargs}, ensure_ascii=False)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO next_steps (chat_id, callback, args, created) VALUES (?, ?, ?, ?)",
+                (handler_group_id, handler.callback.__name__, data, time.time())
+            )
+
+    def clear_handlers(self, handler_group_id):
+        with self._lock:
+            self._db.execute("DELETE FROM next_steps WHERE chat_id = ?", (handler_group_id,))
+
+    def get_handlers(self, handler_group_id):
+        now = time.time()
+        with self._lock:
+            try:
+                rows = self._db.execute(
+                    "SELECT id, callback, args, created FROM next_steps WHERE chat_id = ? ORDER BY id", (handler_group_id,)
+                ).fetchall()
+                if not rows:
+                    return None
+                # Шаг достается тому процессу, который первым удалил его строку
+                self._db.execute("BEGIN IMMEDIATE")
+                claimed = [row for row in rows
+                           if self._db.execute("DELETE FROM next_steps WHERE id = ?", (row[0],)).rowcount]
+                self._db.execute("DELETE FROM next_steps WHERE created < ?", (now - self.ttl,))
+                self._db.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                logger.error(f"Ошибка чтения хранилища шагов: {str(e)}")
+                return None
+        handlers = []
+        for _, callback_name, data, created in claimed:
+            callback = globals().get(callback_name)
+            if callback is None or now - created >= self.ttl:
+                continue
+            data = json.loads(data)
+            handlers.append(telebot.Handler(callback, *data["args"], **data["kwargs"]))
+        return handlers or None
+
+if STEP_DB:
+    try:
+        bot.next_step_backend = SQLiteStepBackend(STEP_DB, STEP_TTL)
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось открыть хранилище шагов {STEP_DB}: {str(e)}. Шаги хранятся в памяти процесса")
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundMessage:
+    """Сообщение, отправка которого поставлена в очередь
+
+    message_id становится известен после отправки; правки и удаление этого
+    сообщения можно ставить в очередь сразу, они выполнятся после отправки.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message = None
+        self.error = None
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def resolve(self, message=None, error=None):
+        self.message = message
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Ждет завершения отправки; True, если сообщение отправлено"""
+        self._done.wait(timeout)
+        return self.message is not None
+
+    @property
+    def message_id(self):
+        self._done.wait()
+        return self.message.message_id if self.message is not None else None
+
+class OutboundOp:
+    """Вызов Bot API в очереди чата"""
+    __slots__ = ('method', 'args', 'kwargs', 'handle', 'target', 'attempts', 'send_if_missing')
+
+    def __init__(self, method, args, kwargs, handle=None, target=None, send_if_missing=False):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.handle = handle
+        self.target = target
+        self.attempts = 0
+        # Правка неотправленного сообщения отправляется новым сообщением
+        self.send_if_missing = send_if_missing
+
+class TelegramDispatcher:
+    """Очередь исходящих вызовов Bot API
+
+    Вызовы одного чата выполняются по порядку, чаты обслуживаются параллельно
+    пулом потоков. Частота ограничивается корзинами токенов на чат и на бота,
+    ответы 429 и сетевые ошибки повторяются после паузы. Правки одного
+    сообщения, ожидающие в очереди, сливаются в одну, а удаление еще не
+    отправленного сообщения отменяет его отправку.
+    """
+
+    # Вызовы, которые не считаются сообщениями в лимите чата
+    UNLIMITED_METHODS = ('send_chat_action', 'delete_message')
+
+    def __init__(self, senders, global_rate, chat_rate, chat_burst, max_retries):
+        self.senders = senders
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chat_buckets = OrderedDict()
+        self._queues = {}
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    def start(self):
+        for i in range(self.senders):
+            thread = threading.Thread(target=self._run, name=f"telegram-sender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Запущена очередь отправки в Telegram: {self.senders} потоков")
+
+    def send(self, chat_id, text, **kwargs):
+        """Ставит в очередь sendMessage, возвращает OutboundMessage"""
+        handle = OutboundMessage(chat_id)
+        self._enqueue(chat_id, OutboundOp('send_message', (chat_id, text), kwargs, handle=handle))
+        return handle
+
+    def chat_action(self, chat_id, action='typing'):
+        with self._cond:
+            pending = self._queues.get(chat_id, ())
+            if any(op.method == 'send_chat_action' for op in pending):
+                self._coalesce(1)
+                return
+        self._enqueue(chat_id, OutboundOp('send_chat_action', (chat_id, action), {}))
+
+    def edit(self, target, text, send_if_missing=False, **kwargs):
+        """Меняет текст сообщения; ожидающая правка того же сообщения заменяется
+
+        С send_if_missing текст отправляется новым сообщением, если target
+        так и не удалось отправить (но не если его отправку отменили).
+        """
+        with self._cond:
+            for op in self._queues.get(target.chat_id, ()):
+                if op.method == 'edit_message_text' and op.target is target:
+                    op.args = (text,)
+                    op.kwargs = kwargs
+                    op.send_if_missing = send_if_missing
+                    self._coalesce(1)
+                    return
+        self._enqueue(target.chat_id, OutboundOp(
+            'edit_message_text', (text,), kwargs, target=target, send_if_missing=send_if_missing
+        ))
+
+    def delete(self, target):
+        """Удаляет сообщение; если оно еще не отправлено, отправка отменяется"""
+        with self._cond:
+            pending = self._queues.get(target.chat_id)
+            if pending and any(op.handle is target for op in pending):
+                dropped = [op for op in pending if op.handle is target or op.target is target]
+                for op in dropped:
+                    pending.remove(op)
+                OUTBOUND_PENDING.dec(len(dropped))
+                self._coalesce(len(dropped))
+                target.cancelled = True
+                target.resolve()
+                return
+        self._enqueue(target.chat_id, OutboundOp('delete_message', (), {}, target=target))
+
+    def flush(self, timeout):
+        """Ждет отправки всего, что стоит в очереди"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queues and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+
+    def _coalesce(self, count):
+        self.coalesced += count
+        DEDUPLICATED.labels('outbound').inc(count)
+
+    def _enqueue(self, chat_id, op):
+        with self._cond:
+            pending = self._queues.get(chat_id)
+            if pending is None:
+                pending = self._queues[chat_id] = deque()
+                self._schedule(chat_id, time.monotonic())
+            pending.append(op)
+            OUTBOUND_PENDING.inc()
+            self._cond.notify()
+
+    def _schedule(self, chat_id, at):
+        self._seq += 1
+        heapq.heappush(self._heap, (at, self._seq, chat_id))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chat_buckets) > 10000:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _next(self):
+        """Берет следующий вызов, для которого есть токены; чат остается занят до его завершения"""
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                at, _, chat_id = self._heap[0]
+                now = time.monotonic()
+                if at > now:
+                    self._cond.wait(at - now)
+                    continue
+                wait = self._global.delay(now)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                pending = self._queues[chat_id]
+                if not pending:
+                    del self._queues[chat_id]
+                    self._cond.notify_all()
+                    continue
+                op = pending[0]
+                if op.method not in self.UNLIMITED_METHODS:
+                    bucket = self._chat_bucket(chat_id)
+                    wait = bucket.delay(now)
+                    if wait > 0:
+                        self._schedule(chat_id, now + wait)
+                        continue
+                    bucket.take()
+                self._global.take()
+                pending.popleft()
+                OUTBOUND_PENDING.dec()
+                return chat_id, op
+
+    def _run(self):
+        while True:
+            chat_id, op = self._next()
+            retry_in = self._execute(op)
+            with self._cond:
+                pending = self._queues[chat_id]
+                if retry_in is not None:
+                    pending.appendleft(op)
+                    OUTBOUND_PENDING.inc()
+                    self._schedule(chat_id, time.monotonic() + retry_in)
+                elif pending:
+                    self._schedule(chat_id, time.monotonic())
+                else:
+                    del self._queues[chat_id]
+                    self._cond.notify_all()
+                self._cond.notify()
+
+    def _execute(self, op):
+        """Выполняет вызов; возвращает паузу перед повтором или None"""
+        method = op.method
+        args = op.args
+        kwargs = dict(op.kwargs)
+        if op.target is not None:
+            message_id = op.target.message_id
+            if message_id is None:
+                if op.target.cancelled or not op.send_if_missing:
+                    # Сообщение не было отправлено или отменено - менять нечего
+                    return None
+                if op.attempts == 0:
+                    logger.warning(f"Сообщение в чате {op.target.chat_id} не было отправлено, отправляем текст заново")
+                method = 'send_message'
+                args = (op.target.chat_id,) + op.args
+            else:
+                kwargs['chat_id'] = op.target.chat_id
+                kwargs['message_id'] = message_id
+        op.attempts += 1
+        try:
+            result = getattr(bot, method)(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and op.attempts <= self.max_retries:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                logger.warning(f"Telegram ограничил частоту ({op.method}), повтор через {retry_after} с")
+                ERRORS.labels('telegram_429').inc()
+                self.retried += 1
+                return float(retry_after)
+            if e.error_code >= 500 and op.attempts <= self.max_retries:
+                self.retried += 1
+                return self._backoff(op.attempts)
+            if e.error_code == 400 and 'message is not modified' in e.description:
+                return self._complete(op, None)
+            if e.error_code == 400 and "can't parse entities" in e.description and op.kwargs.get('parse_mode'):
+                # Ответ модели может содержать символы, ломающие разметку
+                logger.warning(f"Не удалось отправить с разметкой, отправляем без нее: {e.description}")
+                op.kwargs = {k: v for k, v in op.kwargs.items() if k != 'parse_mode'}
+                return 0.0
+            return self._fail(op, e)
+        except ApiHTTPException as e:
+            # 5xx с телом не в JSON (например, страница ошибки прокси)
+            if e.result.status_code >= 500 and op.attempts <= self.max_retries:
+                logger.warning(f"Telegram вернул HTTP {e.result.status_code} ({op.method}), повтор")
+                self.retried += 1
+                return self._backoff(op.attempts)
+            return self._fail(op, e)
+        except requests.RequestException as e:
+            if op.attempts <= self.max_retries:
+                logger.warning(f"Сетевая ошибка Telegram ({op.method}): {str(e)}, повтор")
+                self.retried += 1
+                return self._backoff(op.attempts)
+            return self._fail(op, e)
+        except Exception as e:
+            return self._fail(op, e)
+        return self._complete(op, result)
+
+    def _backoff(self, attempt):
+        return min(30.0, 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def _complete(self, op, result):
+        self.sent += 1
+        if op.handle is not None:
+            op.handle.resolve(result)
+        return None
+
+    def _fail(self, op, error):
+        logger.error(f"Ошибка вызова Telegram {op.method}: {str(error)}")
+        ERRORS.labels('telegram').inc()
+        self.failed += 1
+        if op.handle is not None:
+            op.handle.resolve(error=error)
+        return None
+
+    def stats(self):
+        with self._cond:
+            return {
+                "senders": self.senders,
+                "chats_pending": len(self._queues),
+                "pending": sum(len(pending) for pending in self._queues.values()),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "coalesced": self.coalesced
+            }
+
+dispatcher = TelegramDispatcher(
+    senders=TELEGRAM_SENDERS,
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_SEND_RETRIES
+)
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Делит текст на части не длиннее limit, по возможности по переводам строк"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    chunks.append(text)
+    return chunks
+
+class ProgressiveReply:
+    """Постепенно показывает ответ ИИ, редактируя сообщение о статусе"""
+
+    CURSOR = ' ▌'
+
+    def __init__(self, chat_id, status_message):
+        self.chat_id = chat_id
+        self.messages = [status_message]
+        self._shown = [None]
+        self._last_edit = 0.0
+        self._last_length = 0
+
+    def update(self, text):
+        """Принимает накопленный текст; лишние правки отбрасываются, показывается последний вариант"""
+        if time.monotonic() - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if len(text) - self._last_length < STREAM_MIN_CHARS:
+            return
+        self._last_length = len(text)
+        self._render(split_message(text, TELEGRAM_MESSAGE_LIMIT - len(self.CURSOR)), cursor=True)
+        self._last_edit = time.monotonic()
+
+    def finish(self, text, parse_mode='HTML'):
+        """Ставит в очередь окончательный ответ с форматированием
+
+        Если разметка не принимается Telegram, очередь отправки повторит
+        вызов без нее.
+        """
+        chunks = split_message(text)
+        # Если сообщение о статусе так и не отправилось, ответ придет новым сообщением
+        self._render(chunks, parse_mode=parse_mode, send_if_missing=True)
+        # Лишние сообщения от промежуточного вывода больше не нужны
+        for message in self.messages[len(chunks):]:
+            dispatcher.delete(message)
+        del self.messages[len(chunks):]
+        del self._shown[len(chunks):]
+
+    def _render(self, chunks, cursor=False, parse_mode=None, send_if_missing=False):
+        for i, chunk in enumerate(chunks):
+            if cursor and i == len(chunks) - 1:
+                chunk += self.CURSOR
+            if i < len(self.messages):
+                if self._shown[i] == (chunk, parse_mode):
+                    continue
+                dispatcher.edit(
+                    self.messages[i],
+                    chunk,
+                    send_if_missing=send_if_missing,
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True
+                )
+                self._shown[i] = (chunk, parse_mode)
+            else:
+                self.messages.append(dispatcher.send(
+                    self.chat_id,
+                    chunk,
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True
+                ))
+                self._shown.append((chunk, parse_mode))
+
+def get_available_models():
+    """Возвращает список моделей OpenRouter, кэшированный на диске на MODELS_CACHE_TTL"""
+    try:
+        with open(MODELS_CACHE_FILE, encoding='utf-8') as f:
+            cached = json.load(f)
+        if time.time() - cached['fetched_at'] < MODELS_CACHE_TTL:
+            return cached['models']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    models = openrouter_client.list_models()
+    try:
+        os.makedirs(os.path.dirname(MODELS_CACHE_FILE) or '.', exist_ok=True)
+        tmp_path = f"{MODELS_CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"fetched_at": time.time(), "models": models}, f)
+        os.replace(tmp_path, MODELS_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить список моделей: {str(e)}")
+    return models
 
 def check_model_availability():
-    """Проверяет доступность модели на OpenRouter"""
+    """Проверяет доступность моделей на OpenRouter; недоступные маршрутизатор пропускает"""
     try:
-        logger.info("Проверка доступности модели...")
-        url = "https://openrouter.ai/api/v1/models"
-        response = requests.get(url, headers=OPENROUTER_HEADERS, timeout=15)
-        
-        if response.status_code == 200:
-            models = [m['id'] for m in response.json().get('data', [])]
-            target_model = "qwen/qwen2.5-72b-chat"
-            
+        logger.info("Проверка доступности моделей...")
+        models = set(get_available_models())
+        model_router.set_available(models)
+
+        for target_model in model_router.stats()["models"]:
             if target_model in models:
                 logger.info(f"✅ Модель {target_model} доступна")
             else:
-                available_models = ", ".join(models)
-                logger.warning(f"❌ Модель {target_model} недоступна! Доступные модели: {available_models}")
-        else:
-            logger.error(f"Ошибка получения списка моделей: {response.status_code}")
+                logger.warning(f"❌ Модель {target_model} недоступна и будет использоваться только в крайнем случае")
     except Exception as e:
         logger.error(f"Ошибка проверки моделей: {str(e)}")
 
+class HistoryRecord:
+    """Одна запись истории; __slots__ экономит память на миллионах записей"""
+
+    __slots__ = ('question', 'response', 'created')
+
+    def __init__(self, question, response, created=None):
+        self.question = question
+        self.response = response
+        self.created = created if created is not None else time.time()
+
+    def size(self):
+        return len(self.question) + len(self.response) + 64
+
+class HistoryStore(ABC):
+    """Интерфейс хранилища истории запросов"""
+
+    @abstractmethod
+    def append(self, chat_id, question, response):
+        """Добавляет запись в историю чата"""
+
+    @abstractmethod
+    def get(self, chat_id):
+        """Возвращает записи чата от старых к новым"""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        return {}
+
+class MemoryHistoryStore(HistoryStore):
+    """История в памяти процесса: последние записи каждого чата, неактивные чаты вытесняются"""
+
+    def __init__(self, per_chat, max_bytes):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def append(self, chat_id, question, response):
+        with self._lock:
+            self._add(chat_id, HistoryRecord(question, response))
+
+    def get(self, chat_id):
+        with self._lock:
+            records = self._chats.get(chat_id)
+            if records is None:
+                return []
+            self._chats.move_to_end(chat_id)
+            return list(records)
+
+    def _add(self, chat_id, record):
+        records = self._chats.get(chat_id)
+        if records is None:
+            records = self._chats[chat_id] = deque(maxlen=self.per_chat)
+        if len(records) == records.maxlen:
+            self._bytes -= records[0].size()
+        records.append(record)
+        self._bytes += record.size()
+        self._chats.move_to_end(chat_id)
+        self._evict()
+
+    def _evict(self):
+        # Самый давно активный чат вытесняется первым, но текущий остается
+        while self._bytes > self.max_bytes and len(self._chats) > 1:
+            _, records = self._chats.popitem(last=False)
+            self._bytes -= sum(r.size() for r in records)
+            self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "bytes": self._bytes,
+                "evicted_chats": self.evicted
+            }
+
+class SQLiteHistoryStore(HistoryStore):
+    """История в общем SQLite-файле с отложенной записью
+
+    Записи пишутся в базу пачками фоновым потоком. Читается история всегда из
+    базы: записи одного чата приходят в разные процессы сервера, и копия в
+    памяти процесса была бы неполной.
+    """
+
+    def __init__(self, path, per_chat, flush_interval):
+        self.per_chat = per_chat
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = open_sqlite(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, "
+            "question TEXT NOT NULL, response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS history_chat ON history(chat_id, id)")
+        self._flusher = threading.Thread(target=self._flush_loop, name="history-flusher", daemon=True)
+        self._flusher.start()
+
+    def append(self, chat_id, question, response):
+        with self._lock:
+            self._pending.append((chat_id, HistoryRecord(question, response)))
+
+    def get(self, chat_id):
+        self.flush()
+        try:
+            with self._db_lock:
+                rows = self._db.execute(
+                    "SELECT question, response, created FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                    (chat_id, self.per_chat)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения истории: {str(e)}")
+            rows = []
+        records = [HistoryRecord(*row) for row in reversed(rows)]
+        # Записи, которые не удалось сохранить, ждут следующей попытки в очереди
+        with self._lock:
+            records += [record for pending_chat, record in self._pending if pending_chat == chat_id]
+        return records[-self.per_chat:]
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT INTO history (chat_id, question, response, created) VALUES (?, ?, ?, ?)",
+                    [(chat_id, r.question, r.response, r.created) for chat_id, r in pending]
+                )
+                for chat_id in {chat_id for chat_id, _ in pending}:
+                    self._db.execute(
+                        "DELETE FROM history WHERE chat_id = ? AND id NOT IN "
+                        "(SELECT id FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT ?)",
+                        (chat_id, chat_id, self.per_chat)
+                    )
+                self._db.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи истории ({len(pending)} записей): {str(e)}")
+            try:
+                self._db.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            # Вернем записи в очередь, чтобы не потерять их
+            with self._lock:
+                self._pending[:0] = pending
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"pending_writes": len(self._pending)}
+
+def create_history_store():
+    """Создает хранилище истории по HISTORY_BACKEND"""
+    if HISTORY_BACKEND == 'sqlite':
+        try:
+            return SQLiteHistoryStore(HISTORY_DB, HISTORY_PER_CHAT, HISTORY_FLUSH_INTERVAL)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось открыть историю {HISTORY_DB}: {str(e)}. История хранится в памяти")
+    return MemoryHistoryStore(HISTORY_PER_CHAT, HISTORY_MEMORY_BYTES)
+
+history_store = create_history_store()
+atexit.register(history_store.close)
+
 def save_history(user_id, question, response):
     """Сохраняет историю запросов пользователя"""
-    if user_id not in user_history:
-        user_history[user_id] = []
-    # Сохраняем только последние 10 записей
-    if len(user_history[user_id]) >= 10:
-        user_history[user_id].pop(0)
-    user_history[user_id].append({
-        "question": question,
-        "response": response
-    })
-
-def process_image(image_data):
-    """Распознает текст на изображении с оптимизированной обработкой"""
+    history_store.append(user_id, question, response)
+
+class OCRWorkerProcess:
+    """Один долгоживущий процесс ocr_worker.py с загруженными моделями Tesseract"""
+
+    HEADER = struct.Struct('>III')
+
+    def __init__(self, index):
+        self.index = index
+        self.jobs = 0
+        self.proc = None
+
+    def start(self, timeout):
+        self.launch()
+        return self.wait_ready(timeout)
+
+    def launch(self):
+        """Запускает процесс, не дожидаясь загрузки моделей"""
+        env = dict(os.environ, OCR_LANG=OCR_LANG, OCR_PSM=str(OCR_PSM), OCR_OEM=str(OCR_OEM))
+        self.proc = subprocess.Popen(
+            [sys.executable, OCR_WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+            env=env
+        )
+
+    def wait_ready(self, timeout):
+        hello = self._read_message(time.monotonic() + timeout)
+        if not hello.get('ready'):
+            raise RuntimeError(hello.get('error', 'worker не запустился'))
+        self.jobs = 0
+        return hello
+
+    def run(self, image, timeout):
+        """Распознает изображение в режиме L, возвращает (текст, уверенность)"""
+        data = image.tobytes()
+        width, height = image.size
+        self.proc.stdin.write(self.HEADER.pack(width, height, len(data)))
+        self.proc.stdin.write(data)
+        reply = self._read_message(time.monotonic() + timeout)
+        self.jobs += 1
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply['text'], reply['confidence']
+
+    def _read_message(self, deadline):
+        fd = self.proc.stdout.fileno()
+        buffer = b''
+        while not buffer.endswith(b'\n'):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"OCR worker {self.index} не ответил вовремя")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise RuntimeError(f"OCR worker {self.index} завершился")
+            buffer += chunk
+        return json.loads(buffer)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+class OCREngine:
+    """Пул долгоживущих процессов Tesseract с запасным путем через pytesseract"""
+
+    def __init__(self, mode, workers, job_timeout, max_jobs_per_worker, start_timeout):
+        self.mode = mode
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.start_timeout = start_timeout
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self.alive = 0
+        self.jobs = 0
+        self.fallbacks = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    @property
+    def available(self):
+        return self.alive > 0
+
+    def start(self):
+        """Запускает процессы пула; при ошибке остается работать через pytesseract"""
+        if self.mode != 'pool':
+            logger.info("OCR работает через pytesseract")
+            return
+        # Процессы загружают модели параллельно
+        workers = [OCRWorkerProcess(i) for i in range(self.workers)]
+        for worker in workers:
+            worker.launch()
+        hello = {}
+        for worker in workers:
+            try:
+                hello = worker.wait_ready(self.start_timeout)
+            except Exception as e:
+                logger.error(f"Не удалось запустить OCR worker {worker.index}: {str(e)}")
+                worker.stop()
+                continue
+            self._idle.put(worker)
+            with self._lock:
+                self.alive += 1
+        if self.alive:
+            logger.info(f"Запущен пул OCR: {self.alive} процессов, Tesseract {hello.get('version')}")
+        else:
+            logger.error("Пул OCR не запустился, используется pytesseract")
+
+    def recognize(self, image):
+        """Возвращает (текст, средняя уверенность или None)"""
+        if not self.available:
+            return self._fallback(image)
+
+        worker = None
+        while worker is None:
+            try:
+                worker = self._idle.get(timeout=1)
+            except queue.Empty:
+                if not self.available:
+                    return self._fallback(image)
+        try:
+            if worker.jobs >= self.max_jobs_per_worker:
+                worker = self._restart(worker, "плановый перезапуск")
+                if worker is None:
+                    return self._fallback(image)
+            result = worker.run(image, self.job_timeout)
+            with self._lock:
+                self.jobs += 1
+            return result
+        except TimeoutError as e:
+            logger.error(str(e))
+            with self._lock:
+                self.timeouts += 1
+            worker = self._restart(worker, "таймаут")
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка OCR worker {worker.index}: {str(e)}")
+            worker = self._restart(worker, "сбой")
+            return self._fallback(image)
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+
+    def _restart(self, worker, reason):
+        """Перезапускает процесс; возвращает None, если запустить не удалось"""
+        logger.info(f"Перезапуск OCR worker {worker.index} после {worker.jobs} задач: {reason}")
+        worker.stop()
+        with self._lock:
+            self.restarts += 1
+        try:
+            worker.start(self.start_timeout)
+            return worker
+        except Exception as e:
+            logger.error(f"OCR worker {worker.index} не перезапустился: {str(e)}")
+            worker.stop()
+            with self._lock:
+                self.alive -= 1
+            return None
+
+    def _fallback(self, image):
+        with self._lock:
+            self.fallbacks += 1
+        text = pytesseract.image_to_string(image, config=OCR_CONFIG, timeout=self.job_timeout)
+        return text, None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode if self.available else 'pytesseract',
+                "workers": self.alive,
+                "idle": self._idle.qsize(),
+                "jobs": self.jobs,
+                "fallbacks": self.fallbacks,
+                "timeouts": self.timeouts,
+                "restarts": self.restarts
+            }
+
+ocr_engine = OCREngine(
+    mode=OCR_ENGINE,
+    workers=OCR_WORKERS,
+    job_timeout=OCR_JOB_TIMEOUT,
+    max_jobs_per_worker=OCR_WORKER_MAX_JOBS,
+    start_timeout=OCR_WORKER_START_TIMEOUT
+)
+
+def recognize_image(image, dpi=OCR_TARGET_DPI):
+    """Распознает текст на уже открытом изображении, возвращает (текст, уверенность)"""
     try:
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Оптимизированная предобработка
-        if image.mode != 'L':
-            image = image.convert('L')
-        
-        # Быстрая обработка
-        image = ImageOps.autocontrast(image, cutoff=5)
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(2.0)
-        image = image.filter(ImageFilter.SHARPEN)
-        image = image.point(lambda p: 255 if p > 160 else 0)
+        # Уменьшаем до целевого разрешения текста и бинаризуем
+        with OCR_PREPROCESS_LATENCY.labels(OCR_PREPROCESS).time():
+            image = preprocess_image(image, OCR_PREPROCESS, dpi)
         
         # Распознаем текст
-        custom_config = r'--oem 3 --psm 6 -l rus+eng'
-        text = pytesseract.image_to_string(image, config=custom_config)
+        with OCR_TESSERACT_LATENCY.time():
+            text, confidence = ocr_engine.recognize(image)
         text = re.sub(r'\s+', ' ', text).strip()
         
         logger.info(f"Распознано символов: {len(text)}")
-        return text
+        return text, confidence
     except Exception as e:
         logger.error(f"Ошибка OCR: {str(e)}")
-        return None
+        ERRORS.labels('ocr').inc()
+        return None, None
+
+def perceptual_hash(image, size=16):
+    """Считает dHash из size*size бит: устойчив к пересжатию"""
+    small = image.convert('L').resize((size + 1, size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+def image_key(image):
+    """Ключ кэша OCR: размеры изображения и 256-битный перцептивный хэш"""
+    return f"{image.width}x{image.height}:{perceptual_hash(image):064x}"
+
+def _parse_image_key(key):
+    size, phash = key.split(':')
+    return size, int(phash, 16)
+
+class OCRCache:
+    """Двухуровневый кэш OCR: по file_unique_id Telegram и по ключу изображения
+
+    Ключ изображения (image_key) совпадает у одного и того же фото, заново
+    загруженного в Telegram. При max_distance > 0 подходит и фото тех же
+    размеров, хэш которого отличается не больше чем на max_distance бит.
+    """
+
+    def __init__(self, path, max_entries, max_bytes, max_distance, disk_max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        self.disk_max_bytes = disk_max_bytes
+        self._texts = OrderedDict()   # ключ изображения -> текст
+        self._files = OrderedDict()   # file_unique_id -> ключ изображения
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._puts_since_trim = 0
+        self.file_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            try:
+                self._db = open_sqlite(path)
+                # Записи по 64-битному хэшу путали разные страницы
+                self._db.execute("DROP TABLE IF EXISTS ocr_texts")
+                self._db.execute("DROP TABLE IF EXISTS ocr_files")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS ocr_images ("
+                    "key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                    "accessed REAL NOT NULL, size INTEGER NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS ocr_images_accessed ON ocr_images(accessed)")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS ocr_file_keys ("
+                    "file_unique_id TEXT PRIMARY KEY, key TEXT NOT NULL, created REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS ocr_file_keys_key ON ocr_file_keys(key)")
+                self._load()
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось открыть кэш OCR {path}: {str(e)}")
+                self._db = None
+
+    def _load(self):
+        """Загружает в память самые свежие записи с диска"""
+        rows = self._db.execute(
+            "SELECT key, text FROM ocr_images ORDER BY accessed DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        for key, text in reversed(rows):
+            self._store(key, text)
+        logger.info(f"Кэш OCR: загружено {len(self._texts)} записей")
+
+    def get_by_file(self, file_unique_id):
+        """Ищет текст по идентификатору файла Telegram, без скачивания"""
+        with self._lock:
+            key = self._files.get(file_unique_id)
+            if key is None and self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT key FROM ocr_file_keys WHERE file_unique_id = ?", (file_unique_id,)
+                    ).fetchone()
+                    if row:
+                        key = row[0]
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка чтения кэша OCR: {str(e)}")
+            text = self._lookup_exact(key) if key is not None else None
+            if text is None:
+                CACHE_REQUESTS.labels('ocr_file', 'miss').inc()
+                return None
+            self._files[file_unique_id] = key
+            self._files.move_to_end(file_unique_id)
+            self.file_hits += 1
+            CACHE_REQUESTS.labels('ocr_file', 'hit').inc()
+            return text
+
+    def get_by_key(self, key):
+        """Ищет текст по ключу изображения; похожие фото - с допуском max_distance бит"""
+        with self._lock:
+            text = self._lookup_exact(key)
+            if text is None and self.max_distance:
+                size, phash = _parse_image_key(key)
+                for known, known_text in self._texts.items():
+                    known_size, known_hash = _parse_image_key(known)
+                    if known_size == size and bin(known_hash ^ phash).count('1') <= self.max_distance:
+                        self._texts.move_to_end(known)
+                        text = known_text
+                        break
+            if text is None:
+                self.misses += 1
+                CACHE_REQUESTS.labels('ocr_hash', 'miss').inc()
+                return None
+            self.hash_hits += 1
+            CACHE_REQUESTS.labels('ocr_hash', 'hit').inc()
+            return text
+
+    def _lookup_exact(self, key):
+        text = self._texts.get(key)
+        if text is not None:
+            self._texts.move_to_end(key)
+            return text
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("SELECT text FROM ocr_images WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE ocr_images SET accessed = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения кэша OCR: {str(e)}")
+            return None
+        if row is None:
+            return None
+        self._store(key, row[0])
+        return row[0]
+
+    def put(self, file_unique_id, key, text):
+        """Сохраняет распознанный текст для файла и ключа его изображения"""
+        with self._lock:
+            self._store(key, text)
+            self._files[file_unique_id] = key
+            self._files.move_to_end(file_unique_id)
+            while len(self._files) > self.max_entries * 4:
+                self._files.popitem(last=False)
+            if self._db is None:
+                return
+            now = time.time()
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO ocr_images (key, text, accessed, size) VALUES (?, ?, ?, ?)",
+                    (key, text, now, len(text.encode('utf-8')))
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO ocr_file_keys (file_unique_id, key, created) VALUES (?, ?, ?)",
+                    (file_unique_id, key, now)
+                )
+                self._puts_since_trim += 1
+                if self._puts_since_trim >= 50:
+                    self._puts_since_trim = 0
+                    self._trim()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка записи кэша OCR: {str(e)}")
+
+    def _trim(self):
+        """Удаляет самые давно использованные тексты сверх disk_max_bytes и ссылки на них"""
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_images").fetchone()[0]
+        if total <= self.disk_max_bytes:
+            return
+        excess = total - self.disk_max_bytes
+        freed = 0
+        keys = []
+        for key, size in self._db.execute("SELECT key, size FROM ocr_images ORDER BY accessed"):
+            keys.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM ocr_images WHERE key = ?", [(k,) for k in keys])
+        self._db.executemany("DELETE FROM ocr_file_keys WHERE key = ?", [(k,) for k in keys])
+        logger.info(f"Кэш OCR: удалено {len(keys)} записей ({freed} байт)")
+
+    def _store(self, key, text):
+        previous = self._texts.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous.encode('utf-8'))
+        self._texts[key] = text
+        self._bytes += len(text.encode('utf-8'))
+        while len(self._texts) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._texts.popitem(last=False)
+            self._bytes -= len(evicted.encode('utf-8'))
+
+    def stats(self):
+        with self._lock:
+            hits = self.file_hits + self.hash_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._texts),
+                "bytes": self._bytes,
+                "file_hits": self.file_hits,
+                "hash_hits": self.hash_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0
+            }
+
+ocr_cache = OCRCache(
+    path=OCR_CACHE_DB,
+    max_entries=OCR_CACHE_ENTRIES,
+    max_bytes=OCR_CACHE_MAX_BYTES,
+    max_distance=OCR_CACHE_HASH_DISTANCE,
+    disk_max_bytes=OCR_CACHE_DISK_MAX_BYTES
+)
+
+def select_photo_variants(photos, min_long_side=OCR_MIN_LONG_SIDE):
+    """Варианты фото для OCR: от наименьшего достаточного размера до самого большого"""
+    variants = sorted(photos, key=lambda p: p.width * p.height)
+    for i, photo in enumerate(variants):
+        if max(photo.width, photo.height) >= min_long_side:
+            return variants[i:]
+    return variants[-1:]
+
+def download_photo(photo):
+    """Скачивает файл Telegram в память с ограничением размера"""
+    with TELEGRAM_FILE_LATENCY.labels('get_file').time():
+        file_info = bot.get_file(photo.file_id)
+    size = file_info.file_size or photo.file_size or 0
+    if size > OCR_MAX_DOWNLOAD_BYTES:
+        raise ValueError(f"Файл слишком большой: {size} байт")
+    url = (telebot.apihelper.FILE_URL or TELEGRAM_FILE_URL).format(BOT_TOKEN, file_info.file_path)
+    chunks = []
+    received = 0
+    with TELEGRAM_FILE_LATENCY.labels('download').time(), \
+            telegram_session.get(url, stream=True, timeout=(5, 30)) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(64 * 1024):
+            received += len(chunk)
+            if received > OCR_MAX_DOWNLOAD_BYTES:
+                raise ValueError(f"Файл больше {OCR_MAX_DOWNLOAD_BYTES} байт")
+            chunks.append(chunk)
+    # Единственная копия: BytesIO поверх bytes не копирует буфер при декодировании
+    return b''.join(chunks)
+
+def is_confident(text, confidence):
+    """Достаточно ли результата OCR, чтобы не скачивать вариант побольше"""
+    if not text or len(text) < OCR_MIN_TEXT_LENGTH:
+        return False
+    return confidence is None or confidence >= OCR_MIN_CONFIDENCE
+
+def recognize_photo(photos):
+    """Возвращает текст с фото Telegram, по возможности без скачивания и OCR
+
+    Сначала распознается наименьший вариант с достаточным разрешением; больший
+    скачивается только если текста мало или Tesseract в нем не уверен. При
+    перегрузке распознается один вариант с меньшим разрешением, а неуверенный
+    результат не кэшируется.
+    """
+    largest = photos[-1]
+    text = ocr_cache.get_by_file(largest.file_unique_id)
+    if text is not None:
+        logger.info(f"Текст фото {largest.file_unique_id} найден в кэше OCR")
+        return text
+
+    degraded = admission.reduced()
+    if degraded:
+        dpi = ADMISSION_OCR_DPI
+        variants = select_photo_variants(photos, OCR_MIN_LONG_SIDE * dpi // OCR_TARGET_DPI)[:1]
+    else:
+        dpi = OCR_TARGET_DPI
+        variants = select_photo_variants(photos)
+    best_text = None
+    for attempt, photo in enumerate(variants):
+        image = decode_image(download_photo(photo), dpi)
+        key = image_key(image)
+
+        # Промежуточные результаты в кэш не попадают, поэтому искать по ключу
+        # изображения имеет смысл только для первого варианта
+        text = ocr_cache.get_by_key(key) if attempt == 0 else None
+        if text is not None:
+            logger.info(f"Текст фото найден в кэше OCR по изображению {key[:24]}")
+            ocr_cache.put(largest.file_unique_id, key, text)
+            return text
+
+        with ocr_limiter:
+            start_time = time.time()
+            text, confidence = recognize_image(image, dpi)
+        elapsed_time = time.time() - start_time
+        logger.info(f"OCR {photo.width}x{photo.height} занял {elapsed_time:.2f} секунд, уверенность {confidence}")
+        if text is None:
+            continue
+
+        if len(text) > len(best_text or ''):
+            best_text = text
+        if is_confident(text, confidence) or photo is variants[-1]:
+            result = text if is_confident(text, confidence) else best_text
+            if not degraded or is_confident(text, confidence):
+                ocr_cache.put(largest.file_unique_id, key, result)
+            return result
+        logger.info(f"Мало текста ({len(text)} символов), пробуем вариант побольше")
+    return best_text
+
+class AlbumCollector:
+    """Собирает фото одного альбома (media_group_id) и передает их on_complete одним списком
+
+    Telegram присылает каждое фото альбома отдельным обновлением. После
+    каждого фото заводится таймер; сработавший таймер забирает группу, если
+    новых фото не было ALBUM_WINDOW секунд. Забор группы атомарен, поэтому
+    альбом обрабатывается один раз, даже если фото попали в разные процессы.
+    Если забрать группу не удалось из-за ошибки SQLite, проверка повторяется.
+    """
+
+    # Сколько раз подряд повторять проверку после ошибки SQLite
+    MAX_CLAIM_RETRIES = 10
+
+    def __init__(self, path, window, on_complete):
+        self.window = window
+        self.on_complete = on_complete
+        self._lock = threading.Lock()
+        # Таймеры и обрабатываемые альбомы: их ждет shutdown
+        self._active = 0
+        self._idle = threading.Condition()
+        self._memory = {}
+        self._adds_since_cleanup = 0
+        self.albums = 0
+        self.photos = 0
+        self._db = None
+        if path:
+            try:
+                self._db = open_sqlite(path)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS album_photos ("
+                    "media_group_id TEXT NOT NULL, message_id INTEGER NOT NULL, "
+                    "message TEXT NOT NULL, received REAL NOT NULL, "
+                    "PRIMARY KEY (media_group_id, message_id))"
+                )
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось открыть буфер альбомов {path}: {str(e)}")
+                self._db = None
+
+    def add(self, message):
+        """Запоминает фото альбома и заводит таймер проверки"""
+        group_id = message.media_group_id
+        now = time.time()
+        with self._lock:
+            self.photos += 1
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO album_photos (media_group_id, message_id, message, received) VALUES (?, ?, ?, ?)",
+                        (group_id, message.message_id, json.dumps(message.json, ensure_ascii=False), now)
+                    )
+                    self._adds_since_cleanup += 1
+                    if self._adds_since_cleanup >= 100:
+                        # Фото, которые никто не забрал (процесс завершился до таймера)
+                        self._adds_since_cleanup = 0
+                        self._db.execute("DELETE FROM album_photos WHERE received < ?", (now - 3600,))
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка записи фото альбома: {str(e)}")
+                    self._memory.setdefault(group_id, {})[message.message_id] = (message.json, now)
+            else:
+                self._memory.setdefault(group_id, {})[message.message_id] = (message.json, now)
+        self._schedule(group_id, self.window)
+
+    def _schedule(self, group_id, delay, retries=0):
+        with self._idle:
+            self._active += 1
+        timer = threading.Timer(delay, self._check, args=(group_id, retries))
+        timer.daemon = True
+        timer.start()
+
+    def _check(self, group_id, retries=0):
+        try:
+            self._process(group_id, retries)
+        finally:
+            with self._idle:
+                self._active -= 1
+                self._idle.notify_all()
+
+    def _process(self, group_id, retries):
+        try:
+            result = self._claim(group_id)
+        except sqlite3.Error as e:
+            if retries >= self.MAX_CLAIM_RETRIES:
+                logger.error(f"Альбом {group_id} не удалось забрать из буфера: {str(e)}")
+                ERRORS.labels('album').inc()
+                return
+            logger.warning(f"Ошибка чтения буфера альбомов ({str(e)}), повторная проверка")
+            self._schedule(group_id, self.window, retries + 1)
+            return
+        if result is None:
+            return
+        if isinstance(result, float):
+            self._schedule(group_id, result)
+            return
+        messages = [telebot.types.Message.de_json(data) for data in result]
+        with self._lock:
+            self.albums += 1
+        logger.info(f"Альбом {group_id} собран: {len(messages)} фото")
+        try:
+            with IN_FLIGHT.labels('album').track_inprogress():
+                self.on_complete(messages)
+        except Exception as e:
+            logger.error(f"Ошибка обработки альбома {group_id}: {str(e)}")
+            ERRORS.labels('album').inc()
+
+    def _claim(self, group_id):
+        """Забирает фото группы: список сообщений, пауза до следующей проверки или None"""
+        now = time.time()
+        with self._lock:
+            entries = dict(self._memory.get(group_id, {}))
+            last = max((received for _, received in entries.values()), default=None)
+            rows = []
+            if self._db is not None:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = self._db.execute(
+                        "SELECT message_id, message, received FROM album_photos WHERE media_group_id = ?", (group_id,)
+                    ).fetchall()
+                    if rows:
+                        last = max(last or 0, max(row[2] for row in rows))
+                    if last is not None and now - last >= self.window:
+                        self._db.execute("DELETE FROM album_photos WHERE media_group_id = ?", (group_id,))
+                    self._db.execute("COMMIT")
+                except sqlite3.Error:
+                    self._db.execute("ROLLBACK")
+                    raise
+            if last is None:
+                return None
+            if now - last < self.window:
+                return float(self.window - (now - last))
+            self._memory.pop(group_id, None)
+        for message_id, data, _ in rows:
+            entries[message_id] = (json.loads(data), None)
+        return [entries[message_id][0] for message_id in sorted(entries)]
+
+    def shutdown(self, timeout):
+        """Ждет проверки собираемых альбомов и их обработки; True, если успели"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._active and time.monotonic() < deadline:
+                self._idle.wait(deadline - time.monotonic())
+            if self._active:
+                logger.warning(f"Не дождались обработки альбомов: {self._active}")
+            return not self._active
+
+    def stats(self):
+        with self._lock:
+            return {
+                "albums": self.albums,
+                "photos": self.photos,
+                "pending_in_memory": sum(len(entries) for entries in self._memory.values())
+            }
+
+# Страницы альбома скачиваются и распознаются параллельно, но одновременных
+# OCR в процессе не больше OCR_CONCURRENCY (ocr_limiter). В gunicorn по
+# умолчанию процессов столько же, сколько ядер, и OCR_CONCURRENCY = 1: страницы
+# одного альбома распознаются по очереди, а скачивание следующей идет во время
+# OCR текущей. Остальные ядра заняты запросами других процессов; чтобы альбом
+# использовал несколько ядер, задайте OCR_CONCURRENCY или уменьшите WEB_CONCURRENCY
+album_page_pool = ThreadPoolExecutor(max_workers=max(2, OCR_CONCURRENCY), thread_name_prefix='album-page')
+
+def recognize_album(messages):
+    """Распознает фото альбома (не больше OCR_CONCURRENCY одновременно), возвращает тексты в порядке страниц"""
+    def recognize(message):
+        try:
+            return recognize_photo(message.photo)
+        except Exception as e:
+            logger.error(f"Ошибка распознавания страницы {message.message_id}: {str(e)}")
+            return None
+    return list(album_page_pool.map(recognize, messages))
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
@@ -209,7 +2917,7 @@ def send_welcome(message):
             "4. Убедитесь, что текст занимает большую часть кадра\n"
             "Попробуй отправить мне вопрос или фотографию с заданием!"
         )
-        bot.send_message(
+        dispatcher.send(
             message.chat.id,
             response,
             reply_markup=create_menu()
@@ -226,20 +2934,21 @@ def handle_help(message):
 def handle_ask_question(message):
     try:
         logger.info(f"Обработка 'Задать вопрос' от {message.chat.id}")
-        msg = bot.send_message(message.chat.id, "📝 Введите ваш вопрос (например: 'Что такое фотосинтез?'):", reply_markup=None)
-        bot.register_next_step_handler(msg, process_text_question)
+        # Шаг регистрируется до ответа, чтобы вопрос пользователя не опередил его
+        bot.register_next_step_handler_by_chat_id(message.chat.id, process_text_question)
+        dispatcher.send(message.chat.id, "📝 Введите ваш вопрос (например: 'Что такое фотосинтез?'):", reply_markup=None)
     except Exception as e:
         logger.error(f"Ошибка в handle_ask_question: {str(e)}")
-        bot.send_message(message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=create_menu())
+        dispatcher.send(message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=create_menu())
 
 @bot.message_handler(func=lambda message: message.text == '📷 Отправить фото')
 def handle_ask_photo(message):
     try:
         logger.info(f"Запрос на отправку фото от {message.chat.id}")
-        bot.send_message(message.chat.id, "📸 Отправьте фотографию с заданием:\n• Сфокусируйтесь на тексте\n• Обеспечьте хорошее освещение\n• Держите камеру параллельно тексту", reply_markup=None)
+        dispatcher.send(message.chat.id, "📸 Отправьте фотографию с заданием:\n• Сфокусируйтесь на тексте\n• Обеспечьте хорошее освещение\n• Держите камеру параллельно тексту", reply_markup=None)
     except Exception as e:
         logger.error(f"Ошибка в handle_ask_photo: {str(e)}")
-        bot.send_message(message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=create_menu())
+        dispatcher.send(message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.", reply_markup=create_menu())
 
 def process_text_question(message):
     try:
@@ -248,22 +2957,21 @@ def process_text_question(message):
         logger.info(f"Обработка текстового вопроса от {chat_id}: {question}")
 
         if len(question) < 3:
-            bot.send_message(chat_id, "❌ Вопрос слишком короткий. Пожалуйста, уточните запрос.", reply_markup=create_menu())
+            dispatcher.send(chat_id, "❌ Вопрос слишком короткий. Пожалуйста, уточните запрос.", reply_markup=create_menu())
+            return
+
+        # При перегрузке сразу просим повторить, но ответ из кэша все же отдаем
+        if admission.should_shed() and answer_cache.get(question) is None:
+            dispatcher.send(chat_id, BUSY_MESSAGE, reply_markup=create_menu())
             return
 
         # Удаляем клавиатуру на время обработки
-        bot.send_chat_action(chat_id, 'typing')
-        status_msg = bot.send_message(chat_id, "🔍 Обрабатываю ваш вопрос с помощью ИИ...")
+        dispatcher.chat_action(chat_id, 'typing')
+        status_msg = dispatcher.send(chat_id, "🔍 Обрабатываю ваш вопрос с помощью ИИ...")
         
-        # Получаем ответ от ИИ через OpenRouter
-        ai_answer = query_openrouter_api(question)
-        
-        # Обновляем статус
-        bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=status_msg.message_id,
-            text="✅ Ответ получен!"
-        )
+        # Получаем ответ от ИИ через OpenRouter, показывая его по мере генерации
+        reply = ProgressiveReply(chat_id, status_msg)
+        ai_answer = query_openrouter_api(question, on_progress=reply.update)
         
         # Форматирование ответа
         if "❌" in ai_answer or "⚠️" in ai_answer or "⏰" in ai_answer:
@@ -275,103 +2983,129 @@ def process_text_question(message):
         # Сохраняем в историю
         save_history(chat_id, question, response_text)
         
-        bot.send_message(
-            chat_id=chat_id,
-            text=response_text,
-            parse_mode='HTML',
-            disable_web_page_preview=True,
-            reply_markup=create_menu()
-        )
+        reply.finish(response_text)
         logger.info("Ответ на текстовый вопрос отправлен")
 
     except Exception as e:
         logger.error(f"Ошибка в process_text_question: {str(e)}")
-        bot.send_message(message.chat.id, "⚠️ Произошла ошибка при обработке запроса.", reply_markup=create_menu())
+        ERRORS.labels('handler').inc()
+        dispatcher.send(message.chat.id, "⚠️ Произошла ошибка при обработке запроса.", reply_markup=create_menu())
+
+def answer_recognized_text(chat_id, text, history_question):
+    """Показывает распознанный текст и отвечает на него с помощью ИИ"""
+    if admission.reduced() and len(text) > ADMISSION_PROMPT_CHARS:
+        logger.info(f"Перегрузка: текст для ИИ сокращен с {len(text)} до {ADMISSION_PROMPT_CHARS} символов")
+        text = text[:ADMISSION_PROMPT_CHARS]
+    # Обрезаем длинный текст для отображения
+    display_text = text[:300] + "..." if len(text) > 300 else text
+    dispatcher.send(
+        chat_id,
+        f"📝 Распознанный текст:\n<code>{display_text}</code>",
+        parse_mode='HTML'
+    )
+    
+    # Ищем ответ по распознанному тексту
+    processing_msg = dispatcher.send(chat_id, "🔍 Обрабатываю распознанный текст с помощью ИИ...")
+    reply = ProgressiveReply(chat_id, processing_msg)
+    ai_answer = query_openrouter_api(text, on_progress=reply.update)
+    
+    # Форматирование ответа
+    if "❌" in ai_answer or "⚠️" in ai_answer or "⏰" in ai_answer:
+        response_text = f"🤖 <b>Ошибка обработки фото:</b>\n{ai_answer}"
+    else:
+        response_text = f"🤖 <b>Ответ от ИИ (по распознанному тексту):</b>\n{ai_answer}\n\n"
+        response_text += "<i>Ответ сгенерирован с помощью Qwen 2.5 AI</i>"
+    
+    # Сохраняем в историю
+    save_history(chat_id, history_question, response_text)
+    
+    reply.finish(response_text)
 
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
     try:
         chat_id = message.chat.id
+        if message.media_group_id:
+            # Фото из альбома обрабатываются вместе, когда придут все страницы
+            logger.info(f"Получено фото альбома {message.media_group_id} от {chat_id}")
+            album_collector.add(message)
+            return
         logger.info(f"Получено фото от {chat_id}")
-        # Получаем фото с наилучшим качеством
-        file_id = message.photo[-1].file_id
-        file_info = bot.get_file(file_id)
-        file_data = bot.download_file(file_info.file_path)
-        
-        # Распознаем текст
-        bot.send_chat_action(chat_id, 'typing')
-        start_time = time.time()
-        text = process_image(file_data)
-        elapsed_time = time.time() - start_time
-        logger.info(f"OCR занял {elapsed_time:.2f} секунд")
+        if admission.should_shed():
+            dispatcher.send(chat_id, BUSY_MESSAGE, reply_markup=create_menu())
+            return
+        # Распознаем текст, начиная с наименьшего подходящего варианта фото
+        dispatcher.chat_action(chat_id, 'typing')
+        text = recognize_photo(message.photo)
         
         if not text or len(text) < 5:
-            bot.send_message(
+            dispatcher.send(
                 chat_id, 
                 "❌ Не удалось распознать текст на фото.\nПопробуйте:\n• Улучшить освещение\n• Сфокусироваться на тексте\n• Сделать фото под прямым углом",
                 reply_markup=create_menu()
             )
             return
             
-        # Обрезаем длинный текст для отображения
-        display_text = text[:300] + "..." if len(text) > 300 else text
-        bot.send_message(
-            chat_id,
-            f"📝 Распознанный текст:\n<code>{display_text}</code>",
-            parse_mode='HTML'
-        )
-        
-        # Ищем ответ по распознанному тексту
-        processing_msg = bot.send_message(chat_id, "🔍 Обрабатываю распознанный текст с помощью ИИ...")
-        ai_answer = query_openrouter_api(text)
-        
-        # Удаляем сообщение о обработке
-        try:
-            bot.delete_message(chat_id, processing_msg.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить сообщение: {str(e)}")
-        
-        # Форматирование ответа
-        if "❌" in ai_answer or "⚠️" in ai_answer or "⏰" in ai_answer:
-            response_text = f"🤖 <b>Ошибка обработки фото:</b>\n{ai_answer}"
-        else:
-            response_text = f"🤖 <b>Ответ от ИИ (по распознанному тексту):</b>\n{ai_answer}\n\n"
-            response_text += "<i>Ответ сгенерирован с помощью Qwen 2.5 AI</i>"
-        
-        # Сохраняем в историю
-        save_history(chat_id, f"Фото: {text[:50]}...", response_text)
-        
-        bot.send_message(
-            chat_id=chat_id,
-            text=response_text,
-            parse_mode='HTML',
-            disable_web_page_preview=True,
-            reply_markup=create_menu()
-        )
+        answer_recognized_text(chat_id, text, f"Фото: {text[:50]}...")
         logger.info("Ответ по фото отправлен")
     except Exception as e:
         logger.error(f"Ошибка обработки фото: {str(e)}")
-        bot.send_message(chat_id, "⚠️ Произошла ошибка при обработке изображения.", reply_markup=create_menu())
+        ERRORS.labels('handler').inc()
+        dispatcher.send(chat_id, "⚠️ Произошла ошибка при обработке изображения.", reply_markup=create_menu())
+
+def process_album(messages):
+    """Распознает все страницы альбома и отвечает одним сообщением"""
+    chat_id = messages[0].chat.id
+    try:
+        if admission.should_shed():
+            dispatcher.send(chat_id, BUSY_MESSAGE, reply_markup=create_menu())
+            return
+        dispatcher.chat_action(chat_id, 'typing')
+        texts = recognize_album(messages)
+        pages = [
+            f"Страница {number}:\n{text}"
+            for number, text in enumerate(texts, 1)
+            if text and len(text) >= 5
+        ]
+        if not pages:
+            dispatcher.send(
+                chat_id,
+                "❌ Не удалось распознать текст ни на одном фото альбома.\nПопробуйте:\n• Улучшить освещение\n• Сфокусироваться на тексте\n• Сделать фото под прямым углом",
+                reply_markup=create_menu()
+            )
+            return
+        if len(pages) < len(messages):
+            logger.info(f"В альбоме распознано {len(pages)} из {len(messages)} фото")
+
+        text = "\n\n".join(pages)
+        answer_recognized_text(chat_id, text, f"Альбом ({len(messages)} фото): {text[:50]}...")
+        logger.info(f"Ответ по альбому из {len(messages)} фото отправлен")
+    except Exception as e:
+        logger.error(f"Ошибка обработки альбома: {str(e)}")
+        ERRORS.labels('handler').inc()
+        dispatcher.send(chat_id, "⚠️ Произошла ошибка при обработке изображений.", reply_markup=create_menu())
+
+album_collector = AlbumCollector(ALBUM_DB, ALBUM_WINDOW, process_album)
 
 @bot.message_handler(func=lambda message: message.text == '📚 История')
 def handle_history(message):
     try:
         chat_id = message.chat.id
         logger.info(f"Обработка 'История' от {chat_id}")
-        if chat_id not in user_history or not user_history[chat_id]:
-            bot.send_message(chat_id, "📭 История запросов пуста.", reply_markup=create_menu())
+        history = history_store.get(chat_id)
+        if not history:
+            dispatcher.send(chat_id, "📭 История запросов пуста.", reply_markup=create_menu())
             return
-        history = user_history[chat_id]
         response = "📚 Ваша история запросов:\n\n"
         for i, item in enumerate(reversed(history), 1):
             # Обрезаем длинные вопросы
-            question = item['question'] if len(item['question']) < 50 else item['question'][:50] + "..."
+            question = item.question if len(item.question) < 50 else item.question[:50] + "..."
             response += f"<b>{i}. Вопрос:</b> {question}\n"
             # Показываем первый результат из ответа
-            first_result = item['response'].split('\n')[0] if '\n' in item['response'] else item['response'][:100] + "..."
+            first_result = item.response.split('\n')[0] if '\n' in item.response else item.response[:100] + "..."
             response += f"<b>Ответ:</b> {first_result}\n"
             response += "─" * 20 + "\n"
-        bot.send_message(
+        dispatcher.send(
             chat_id,
             response,
             parse_mode='HTML',
@@ -380,31 +3114,114 @@ def handle_history(message):
         logger.info("История отправлена")
     except Exception as e:
         logger.error(f"Ошибка в handle_history: {str(e)}")
-        bot.send_message(chat_id, "⚠️ Произошла ошибка при получении истории.", reply_markup=create_menu())
+        dispatcher.send(chat_id, "⚠️ Произошла ошибка при получении истории.", reply_markup=create_menu())
 
 @app.route('/')
 def home():
     return "🤖 Telegram Study Bot активен! Используйте /start в Telegram"
 
 @app.route('/health')
+@app.route('/health/live')
 def health_check():
     """Endpoint для проверки работоспособности"""
     return "OK", 200
 
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+@app.route('/health/ready')
+def readiness_check():
+    """Готовность принимать трафик: OCR и клиент LLM прогреты"""
+    state = {name: event.is_set() for name, event in readiness.items()}
+    return state, 200 if all(state.values()) else 503
+
+@app.route('/stats')
+def stats():
+    """Статистика очереди обновлений и пулов OCR/LLM"""
+    return {
+        "webhook_mode": WEBHOOK_MODE,
+        "updates": update_pool.stats(),
+        "admission": admission.stats(),
+        "telegram_outbound": dispatcher.stats(),
+        "ocr": ocr_limiter.stats(),
+        "llm": llm_limiter.stats(),
+        "llm_models": model_router.stats(),
+        "answer_cache": answer_cache.stats(),
+        "update_dedup": update_deduplicator.stats(),
+        "prompt_flights": prompt_flights.stats(),
+        "ocr_cache": ocr_cache.stats(),
+        "ocr_engine": ocr_engine.stats(),
+        "albums": album_collector.stats(),
+        "history": history_store.stats()
+    }
+
 @app.route('/webhook', methods=['POST'])
+@WEBHOOK_LATENCY.time()
+@IN_FLIGHT.labels('webhook').track_inprogress()
 def webhook():
     try:
         if request.headers.get('content-type') == 'application/json':
             json_data = request.get_json()
             logger.info("Получен webhook-запрос")
             update = telebot.types.Update.de_json(json_data)
-            bot.process_new_updates([update])
+            if not update_deduplicator.register(update.update_id):
+                logger.info(f"Повторная доставка update {update.update_id} пропущена")
+                return '', 200
+            if WEBHOOK_MODE == 'async':
+                # Подтверждаем получение сразу, обработка идет в пуле воркеров
+                if not update_pool.submit(update):
+                    logger.warning(f"Очередь обновлений переполнена, update {update.update_id} отклонен")
+                    ERRORS.labels('queue_full').inc()
+                    update_deduplicator.forget(update.update_id)
+                    return 'Queue is full', 503
+                return '', 200
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                update_deduplicator.forget(update.update_id)
+                raise
             return '', 200
         return 'Bad request', 400
     except Exception as e:
         logger.error(f"Ошибка в webhook: {str(e)}")
+        ERRORS.labels('webhook').inc()
         return 'Server error', 500
 
+def acquire_leadership():
+    """Пытается захватить файловую блокировку лидера среди процессов сервера
+
+    Блокировка держится до завершения процесса; если лидер упадет, ее
+    освободит ОС и следующий запущенный процесс снова настроит вебхук.
+    """
+    global leader_lock_file
+    try:
+        directory = os.path.dirname(LEADER_LOCK_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lock_file = open(LEADER_LOCK_FILE, 'a+')
+    except OSError as e:
+        logger.error(f"Не удалось открыть файл блокировки {LEADER_LOCK_FILE}: {str(e)}")
+        return True
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    leader_lock_file = lock_file
+    logger.info(f"Процесс {os.getpid()} стал лидером")
+    return True
+
 def configure_webhook():
     """Настраивает вебхук при запуске приложения"""
     try:
@@ -418,40 +3235,99 @@ def configure_webhook():
             webhook_url = f"{external_url}/webhook"
             logger.info(f"Попытка установки вебхука: {webhook_url}")
             
-            # Удаляем существующий вебхук
-            try:
-                bot.remove_webhook()
-                logger.info("Старый вебхук удален")
-                time.sleep(1)
-            except Exception as e:
-                logger.error(f"Ошибка удаления вебхука: {str(e)}")
-            
-            # Устанавливаем новый вебхук
+            # set_webhook сам заменяет старый вебхук, поэтому удалять его
+            # заранее и ждать не нужно; если адрес не изменился, ничего не делаем
             try:
-                bot.set_webhook(url=webhook_url)
-                logger.info(f"Вебхук установлен: {webhook_url}")
-                
-                # Проверяем информацию о вебхуке
-                webhook_info = bot.get_webhook_info()
-                logger.info(f"Информация о вебхуке: {webhook_info.url}")
-                
+                webhook_info = bot.get_webhook_info(timeout=STARTUP_TIMEOUT)
+                if webhook_info.url == webhook_url:
+                    logger.info(f"Вебхук уже установлен: {webhook_url}")
+                else:
+                    bot.set_webhook(url=webhook_url, timeout=STARTUP_TIMEOUT)
+                    logger.info(f"Вебхук установлен: {webhook_url}")
             except Exception as e:
                 logger.error(f"Ошибка установки вебхука: {str(e)}")
         else:
             # Для локальной разработки
-            bot.remove_webhook()
+            bot.delete_webhook(timeout=STARTUP_TIMEOUT)
             logger.info("Вебхук удален, используется polling")
             
-        # Проверяем доступность модели
-        check_model_availability()
-            
     except Exception as e:
         logger.error(f"Ошибка настройки вебхука: {str(e)}")
 
-# Установка вебхука после определения всех обработчиков
-configure_webhook()
+def warm_up_ocr():
+    """Проверяет Tesseract и запускает пул OCR"""
+    try:
+        tesseract_version = pytesseract.get_tesseract_version()
+        logger.info(f"Tesseract version: {tesseract_version}")
+    except Exception as e:
+        logger.error(f"Tesseract check failed: {str(e)}")
+        return
+    ocr_engine.start()
+    readiness['ocr'].set()
+
+def warm_up_llm():
+    """Устанавливает соединение с OpenRouter; после STARTUP_READY_DEADLINE считает клиент готовым в любом случае"""
+    deadline = time.monotonic() + STARTUP_READY_DEADLINE
+    delay = 0.5
+    while True:
+        try:
+            openrouter_client.warm_up(STARTUP_TIMEOUT)
+            logger.info("Соединение с OpenRouter установлено")
+            break
+        except requests.exceptions.RequestException as e:
+            if time.monotonic() + delay > deadline:
+                logger.warning(f"OpenRouter недоступен при запуске ({str(e)}), начинаем принимать запросы без прогрева")
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+    readiness['llm'].set()
+
+def shutdown():
+    """Дообрабатывает принятые обновления и альбомы и отправляет ответы перед выходом процесса
+
+    В gunicorn вызывается из worker_exit: к моменту atexit пулы потоков
+    concurrent.futures уже не принимают задачи. Повторный вызов безопасен.
+    """
+    deadline = time.monotonic() + UPDATE_DRAIN_TIMEOUT
+    if WEBHOOK_MODE == 'async':
+        update_pool.shutdown(UPDATE_DRAIN_TIMEOUT)
+    # Альбомы обрабатываются в потоках таймеров, вне пула обновлений
+    album_collector.shutdown(max(0.0, deadline - time.monotonic()))
+    dispatcher.flush(5)
+
+def start_services():
+    """Запускает прогрев OCR и LLM, проверку моделей и настройку вебхука
+
+    В режиме STARTUP_MODE=background проверки идут в фоновых потоках и не
+    задерживают импорт приложения; /health/ready отвечает 200 только после
+    прогрева. Доступность моделей проверяет каждый процесс: у каждого свой
+    model_router, а список моделей берется из общего кэша на диске.
+    """
+    tasks = [warm_up_ocr, warm_up_llm, check_model_availability]
+    # Вебхук при нескольких процессах настраивает только один из них
+    if acquire_leadership():
+        tasks.append(configure_webhook)
+    else:
+        logger.info("Вебхук настраивает другой процесс")
+
+    if STARTUP_MODE == 'blocking':
+        for task in tasks:
+            task()
+        return
+    for task in tasks:
+        threading.Thread(target=task, name=f"startup-{task.__name__}", daemon=True).start()
+
+# Запуск пула обработки обновлений, очереди отправки, прогрев и установка вебхука
+# после определения всех обработчиков
+if WEBHOOK_MODE == 'async':
+    update_pool.start()
+dispatcher.start()
+atexit.register(shutdown)
+admission.start()
+start_services()
 
-# Для Docker - запускаем Flask приложение
+# Для локальной разработки - встроенный сервер Flask,
+# в Docker используется gunicorn (см. gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     logger.info(f"Запуск Flask приложения на порту {port}")
@@ -0,0 +1,56 @@
+# Конфигурация gunicorn для продакшена:
+#     gunicorn -c gunicorn.conf.py bot:app
+import glob
+import multiprocessing
+import os
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# Несколько процессов, в каждом - пул потоков для HTTP-запросов
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# bot.py делит ядра под OCR между процессами по этому значению
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# Приложение загружается в каждом процессе отдельно: потоки и процессы OCR,
+# созданные при импорте, не переживают fork. Вебхук настраивает только
+# процесс, захвативший файловую блокировку (см. acquire_leadership в bot.py)
+preload_app = False
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+# Остановка процесса ждет, пока пул дообработает принятые обновления
+# (UPDATE_DRAIN_TIMEOUT в bot.py) и очередь отправки ответов опустеет
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Плановый перезапуск процессов ограничивает рост памяти
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+# Метрики всех процессов собираются через общий каталог prometheus_client;
+# переменную нужно задать до импорта приложения
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/studybot-metrics')
+
+def on_starting(server):
+    """Удаляет файлы метрик прошлого запуска"""
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        os.remove(path)
+
+def worker_exit(server, worker):
+    """Дообрабатывает очередь обновлений до завершения процесса (см. shutdown в bot.py)"""
+    bot = sys.modules.get('bot')
+    if bot is not None:
+        bot.shutdown()
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
@@ -0,0 +1,69 @@
+"""Долгоживущий процесс распознавания текста.
+
+Пул OCR в bot.py запускает этот файл отдельным процессом. Модели Tesseract
+загружаются через tesserocr один раз при старте, дальше процесс принимает
+изображения через stdin без временных файлов: заголовок (ширина, высота,
+длина данных) и байты изображения в режиме 'L'. На каждое изображение
+процесс пишет в stdout одну строку JSON.
+"""
+import json
+import os
+import struct
+import sys
+
+HEADER = struct.Struct('>III')
+
+def read_exact(stream, size):
+    """Читает ровно size байт или возвращает None, если поток закрыт"""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def send(stream, message):
+    stream.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+    stream.flush()
+
+def main():
+    lang = os.environ.get('OCR_LANG', 'rus+eng')
+    psm = int(os.environ.get('OCR_PSM', 6))
+    oem = int(os.environ.get('OCR_OEM', 3))
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    try:
+        import tesserocr
+        api = tesserocr.PyTessBaseAPI(lang=lang, psm=psm, oem=oem)
+    except Exception as e:
+        send(stdout, {"ready": False, "error": str(e)})
+        return 1
+    send(stdout, {"ready": True, "version": tesserocr.tesseract_version().split('\n')[0]})
+
+    try:
+        while True:
+            header = read_exact(stdin, HEADER.size)
+            if header is None:
+                break
+            width, height, length = HEADER.unpack(header)
+            data = read_exact(stdin, length)
+            if data is None:
+                break
+            try:
+                api.SetImageBytes(data, width, height, 1, width)
+                text = api.GetUTF8Text()
+                send(stdout, {"text": text, "confidence": api.MeanTextConf()})
+            except Exception as e:
+                send(stdout, {"error": str(e)})
+            finally:
+                api.Clear()
+    finally:
+        api.End()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""Предобработка изображений перед OCR.
+
+Модуль не зависит от bot.py, чтобы его можно было использовать в бенчмарках
+без токенов и сетевых вызовов. Все попиксельные операции выполняются через
+таблицы подстановки Pillow или векторно через NumPy.
+"""
+import io
+import time
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+PREPROCESS_MODES = ('legacy', 'fast', 'adaptive', 'deskew')
+
+# Длинная сторона листа A4 в дюймах: по ней считаем целевое разрешение текста
+PAGE_LONG_SIDE_INCHES = 11.69
+
+THRESHOLD_LEVEL = 160
+
+def target_size(size, dpi):
+    """Размер, при котором длинная сторона соответствует dpi для листа A4; не увеличивает"""
+    width, height = size
+    limit = int(dpi * PAGE_LONG_SIDE_INCHES)
+    long_side = max(width, height)
+    if long_side <= limit:
+        return size
+    scale = limit / long_side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def decode_image(data, dpi=None):
+    """Открывает изображение; JPEG сразу декодируется в оттенках серого и уменьшенным"""
+    image = Image.open(data if hasattr(data, 'read') else io.BytesIO(data))
+    if dpi and image.format == 'JPEG':
+        # draft масштабирует прямо в декодере DCT, не ниже запрошенного размера
+        image.draft('L', target_size(image.size, dpi))
+    return image
+
+def downscale(image, dpi):
+    size = target_size(image.size, dpi)
+    if size == image.size:
+        return image
+    return image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+def to_grayscale(image):
+    return image if image.mode == 'L' else image.convert('L')
+
+def contrast_lut(image, cutoff=5, factor=2.0):
+    """Одна таблица вместо autocontrast(cutoff) + ImageEnhance.Contrast(factor)"""
+    histogram = image.histogram()
+    total = sum(histogram)
+    cut = total * cutoff // 100
+
+    low, seen = 0, 0
+    for low in range(256):
+        seen += histogram[low]
+        if seen > cut:
+            break
+    high, seen = 255, 0
+    for high in range(255, -1, -1):
+        seen += histogram[high]
+        if seen > cut:
+            break
+
+    if high <= low:
+        stretch = list(range(256))
+    else:
+        scale = 255.0 / (high - low)
+        stretch = [min(255, max(0, int((i - low) * scale))) for i in range(256)]
+
+    mean = sum(count * stretch[i] for i, count in enumerate(histogram)) / total if total else 128
+    mean = int(mean + 0.5)
+    return [min(255, max(0, int(mean + factor * (value - mean) + 0.5))) for value in stretch]
+
+def threshold_lut(level=THRESHOLD_LEVEL):
+    return [255 if i > level else 0 for i in range(256)]
+
+def sauvola_binarize(image, window=None, k=0.2, r=128.0):
+    """Адаптивная бинаризация Sauvola через интегральные изображения"""
+    pixels = np.asarray(image, dtype=np.float64)
+    height, width = pixels.shape
+    if window is None:
+        window = max(15, min(height, width) // 40)
+    window |= 1
+    half = window // 2
+
+    padded = np.pad(pixels, half, mode='reflect')
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1))
+    integral_sq = np.zeros_like(integral)
+    np.cumsum(np.cumsum(padded, axis=0), axis=1, out=integral[1:, 1:])
+    np.cumsum(np.cumsum(padded * padded, axis=0), axis=1, out=integral_sq[1:, 1:])
+
+    def window_sum(table):
+        return (table[window:, window:] - table[:-window, window:]
+                - table[window:, :-window] + table[:-window, :-window])
+
+    area = float(window * window)
+    mean = window_sum(integral) / area
+    variance = window_sum(integral_sq) / area - mean * mean
+    std = np.sqrt(np.maximum(variance, 0.0))
+    threshold = mean * (1.0 + k * (std / r - 1.0))
+
+    binary = np.where(pixels > threshold, 255, 0).astype(np.uint8)
+    return Image.fromarray(binary, mode='L')
+
+def estimate_skew(image, max_angle=5.0, step=0.5, probe_width=800):
+    """Угол наклона строк в градусах по дисперсии горизонтальной проекции"""
+    probe = image
+    if probe.width > probe_width:
+        probe = probe.resize((probe_width, max(1, probe.height * probe_width // probe.width)), Image.BILINEAR)
+    # Текст темный: инвертируем, чтобы строки давали большие суммы
+    probe = ImageOps.invert(probe)
+
+    best_angle, best_score = 0.0, -1.0
+    steps = int(max_angle / step)
+    for i in range(-steps, steps + 1):
+        angle = i * step
+        rotated = probe.rotate(angle, resample=Image.BILINEAR, fillcolor=0)
+        profile = np.asarray(rotated, dtype=np.float32).sum(axis=1)
+        score = float(np.var(profile))
+        if score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle
+
+def deskew(image, max_angle=5.0):
+    angle = estimate_skew(image, max_angle)
+    if not angle:
+        return image
+    rotated = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    return rotated.point(threshold_lut(127))
+
+def legacy_preprocess(image):
+    """Прежняя цепочка обработки, оставлена для сравнения"""
+    image = to_grayscale(image)
+    image = ImageOps.autocontrast(image, cutoff=5)
+    enhancer = ImageEnhance.Contrast(image)
+    image = enhancer.enhance(2.0)
+    image = image.filter(ImageFilter.SHARPEN)
+    image = image.point(lambda p: 255 if p > THRESHOLD_LEVEL else 0)
+    return image
+
+def _timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+    return result
+
+def preprocess_image(image, mode='fast', dpi=200, timings=None):
+    """Готовит изображение для Tesseract; timings, если передан, заполняется временем этапов"""
+    if mode not in PREPROCESS_MODES:
+        raise ValueError(f"Неизвестный режим предобработки: {mode}")
+    if mode == 'legacy':
+        return _timed(timings, 'legacy', legacy_preprocess, image)
+
+    image = _timed(timings, 'grayscale', to_grayscale, image)
+    image = _timed(timings, 'downscale', downscale, image, dpi)
+    if mode == 'fast':
+        image = _timed(timings, 'contrast', lambda img: img.point(contrast_lut(img)), image)
+        image = _timed(timings, 'sharpen', image.filter, ImageFilter.SHARPEN)
+        return _timed(timings, 'threshold', image.point, threshold_lut())
+
+    image = _timed(timings, 'binarize', sauvola_binarize, image)
+    if mode == 'deskew':
+        image = _timed(timings, 'deskew', deskew, image)
+    return image
@@ -0,0 +1,13 @@
+"""Общие настройки тестов: окружение, при котором bot.py импортируется без сети"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:test')
+os.environ.setdefault('OPENROUTER_API_KEY', 'test')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://127.0.0.1:9')
+os.environ.setdefault('OPENROUTER_BASE_URL', 'http://127.0.0.1:9')
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='studybot-test-'))
+os.environ.setdefault('OCR_ENGINE', 'pytesseract')
+os.environ.setdefault('ADMISSION_ENABLED', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+"""Тесты переключения уровней деградации (AdmissionController)"""
+import time
+
+import bot
+
+def make_controller(cooldown=60):
+    return bot.AdmissionController(
+        enabled=True,
+        queue_levels=[0.5, 0.8, 0.95],
+        ocr_levels=[2, 4, 8],
+        llm_levels=[2, 10],
+        interval=1,
+        cooldown=cooldown
+    )
+
+def test_idle_bot_stays_normal():
+    controller = make_controller()
+    for _ in range(20):
+        controller.observe_llm_wait(0.0)
+    controller.evaluate()
+    assert controller.stats()['level'] == 'normal'
+    assert controller.transitions == 0
+
+def test_long_waits_for_llm_slot_raise_level_at_once():
+    controller = make_controller()
+    for _ in range(20):
+        controller.observe_llm_wait(12.0)
+    controller.evaluate()
+    assert controller.stats()['level'] == 'cache_only'
+    assert controller.cache_only()
+    assert not controller.should_shed()
+
+def test_level_goes_down_one_step_after_cooldown():
+    controller = make_controller(cooldown=0.05)
+    for _ in range(20):
+        controller.observe_llm_wait(12.0)
+    controller.evaluate()
+    controller._llm_waits.clear()
+    controller.evaluate()
+    # Спокойствие только началось: уровень держится
+    assert controller.stats()['level'] == 'cache_only'
+    time.sleep(0.1)
+    controller.evaluate()
+    assert controller.stats()['level'] == 'reduced'
+    time.sleep(0.1)
+    controller.evaluate()
+    assert controller.stats()['level'] == 'normal'
+
+def test_few_samples_do_not_count():
+    controller = make_controller()
+    for _ in range(4):
+        controller.observe_llm_wait(30.0)
+    controller.evaluate()
+    assert controller.stats()['level'] == 'normal'
@@ -0,0 +1,62 @@
+"""Тесты сборки альбомов (AlbumCollector)"""
+import sqlite3
+import threading
+import time
+
+import telebot
+
+import bot
+
+def photo_message(message_id, group_id='album-1'):
+    return telebot.types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': 1, 'type': 'private'},
+        'media_group_id': group_id
+    })
+
+class Recorder:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.albums = []
+        self.done = threading.Event()
+
+    def __call__(self, messages):
+        time.sleep(self.delay)
+        self.albums.append([m.message_id for m in messages])
+        self.done.set()
+
+def test_photos_are_collected_in_page_order():
+    recorder = Recorder()
+    collector = bot.AlbumCollector('', 0.05, recorder)
+    for message_id in (3, 1, 2):
+        collector.add(photo_message(message_id))
+    assert recorder.done.wait(2)
+    assert collector.shutdown(2)
+    assert recorder.albums == [[1, 2, 3]]
+
+def test_claim_is_retried_after_sqlite_error(tmp_path):
+    recorder = Recorder()
+    collector = bot.AlbumCollector(str(tmp_path / 'albums.sqlite3'), 0.05, recorder)
+    claim = collector._claim
+    failures = []
+
+    def flaky_claim(group_id):
+        if not failures:
+            failures.append(group_id)
+            raise sqlite3.OperationalError('database is locked')
+        return claim(group_id)
+
+    collector._claim = flaky_claim
+    collector.add(photo_message(1))
+    collector.add(photo_message(2))
+    assert collector.shutdown(2)
+    assert failures
+    assert recorder.albums == [[1, 2]]
+
+def test_shutdown_waits_for_album_processing():
+    recorder = Recorder(delay=0.3)
+    collector = bot.AlbumCollector('', 0.05, recorder)
+    collector.add(photo_message(1))
+    assert collector.shutdown(2)
+    assert recorder.albums == [[1]]
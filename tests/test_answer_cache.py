@@ -0,0 +1,42 @@
+"""Тесты ключа и хранения кэша ответов (normalize_prompt, AnswerCache)"""
+import os
+
+import pytest
+
+import bot
+
+@pytest.mark.parametrize('first, second', [
+    ("Решите уравнение 3x + 7 = 22", "Решите уравнение 3x - 7 = 22"),
+    ("Решите неравенство x > 5", "Решите неравенство x < 5"),
+    ("Вычислите 10/2", "Вычислите 10*2"),
+    ("Вычислите 2^3", "Вычислите 2*3"),
+    ("Вычислите (2 + 3) * 4", "Вычислите 2 + 3 * 4"),
+    ("Сравните 2,5 и 25", "Сравните 25 и 25"),
+    ("Вычислите 1.5 + 1", "Вычислите 15 + 1"),
+])
+def test_different_problems_get_different_keys(first, second):
+    assert bot.normalize_prompt(first) != bot.normalize_prompt(second)
+
+@pytest.mark.parametrize('first, second', [
+    ("Решите уравнение 3x + 7 = 22", "решите   уравнение 3х+7=22?"),
+    ("Что такое «фотосинтез»?", 'что такое "фотосинтез"'),
+    ("Ёж - это кто?!", "еж-это кто."),
+    ("Найдите корень: x = 2.", "найдите корень: x=2"),
+])
+def test_same_problem_gets_same_key(first, second):
+    assert bot.normalize_prompt(first) == bot.normalize_prompt(second)
+
+def test_empty_prompt_has_no_key():
+    cache = bot.AnswerCache(path='', ttl=60, memory_entries=10, max_bytes=1000)
+    assert cache.make_key(' ?! ') is None
+    assert cache.get(' ?! ') is None
+
+def test_answers_survive_restart_and_errors_are_not_cached(tmp_path):
+    path = os.path.join(tmp_path, 'answers.sqlite3')
+    cache = bot.AnswerCache(path=path, ttl=60, memory_entries=10, max_bytes=10000)
+    cache.put("3x + 7 = 22", "x = 5")
+    cache.put("3x - 7 = 22", "❌ Ошибка")
+    restarted = bot.AnswerCache(path=path, ttl=60, memory_entries=10, max_bytes=10000)
+    assert restarted.get("3x+7=22") == "x = 5"
+    assert restarted.disk_hits == 1
+    assert restarted.get("3x - 7 = 22") is None
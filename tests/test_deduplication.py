@@ -0,0 +1,60 @@
+"""Тесты отбрасывания повторов (UpdateDeduplicator, SingleFlight)"""
+import threading
+import time
+
+import bot
+
+def test_redelivered_update_is_dropped_across_processes(tmp_path):
+    path = str(tmp_path / 'updates.sqlite3')
+    first = bot.UpdateDeduplicator(path, window=60, max_entries=10)
+    second = bot.UpdateDeduplicator(path, window=60, max_entries=10)
+    assert first.register(1)
+    assert not first.register(1)
+    assert not second.register(1)
+    assert second.register(2)
+
+def test_forgotten_update_is_processed_again(tmp_path):
+    dedup = bot.UpdateDeduplicator(str(tmp_path / 'updates.sqlite3'), window=60, max_entries=10)
+    assert dedup.register(1)
+    dedup.forget(1)
+    assert dedup.register(1)
+
+def test_update_is_accepted_again_after_window():
+    dedup = bot.UpdateDeduplicator('', window=0.05, max_entries=10)
+    assert dedup.register(1)
+    time.sleep(0.1)
+    assert dedup.register(1)
+
+def test_memory_is_bounded():
+    dedup = bot.UpdateDeduplicator('', window=60, max_entries=3)
+    for update_id in range(10):
+        dedup.register(update_id)
+    assert dedup.stats()['tracked'] == 3
+
+def test_single_flight_runs_concurrent_calls_once():
+    flights = bot.SingleFlight('test')
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return "ответ"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do('вопрос', slow)))
+    leader.start()
+    assert started.wait(2)
+    follower = threading.Thread(target=lambda: results.append(flights.do('вопрос', slow)))
+    follower.start()
+    while flights.stats()['shared'] == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+    assert results == ["ответ", "ответ"]
+    assert calls == [1]
+    # После завершения новый вызов снова выполняет функцию
+    assert flights.do('вопрос', lambda: "новый") == "новый"
@@ -0,0 +1,80 @@
+"""Тесты повторов в очереди отправки в Telegram (TelegramDispatcher)"""
+import requests
+from telebot.apihelper import ApiHTTPException
+
+import bot
+
+def http_error(status_code):
+    """ApiHTTPException, как при ответе прокси со страницей ошибки вместо JSON"""
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = 'Bad Gateway' if status_code >= 500 else 'Not Found'
+    response._content = b'<html>error</html>'
+    return ApiHTTPException('sendMessage', response)
+
+def make_op():
+    return bot.OutboundOp('send_message', (1, 'текст'), {}, handle=bot.OutboundMessage(1))
+
+def make_dispatcher():
+    return bot.TelegramDispatcher(senders=1, global_rate=30, chat_rate=1, chat_burst=3, max_retries=2)
+
+def test_http_5xx_without_json_is_retried(monkeypatch):
+    def send_message(*args, **kwargs):
+        raise http_error(502)
+    monkeypatch.setattr(bot.bot, 'send_message', send_message)
+    dispatcher = make_dispatcher()
+    op = make_op()
+    assert dispatcher._execute(op) is not None
+    assert dispatcher._execute(op) is not None
+    # Попытки исчерпаны - ошибка передается отправителю
+    assert dispatcher._execute(op) is None
+    assert dispatcher.retried == 2
+    assert dispatcher.failed == 1
+    assert isinstance(op.handle.error, ApiHTTPException)
+
+def test_http_4xx_without_json_is_not_retried(monkeypatch):
+    def send_message(*args, **kwargs):
+        raise http_error(404)
+    monkeypatch.setattr(bot.bot, 'send_message', send_message)
+    dispatcher = make_dispatcher()
+    assert dispatcher._execute(make_op()) is None
+    assert dispatcher.retried == 0
+    assert dispatcher.failed == 1
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = bot.TokenBucket(rate=2, capacity=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0.0
+        bucket.take()
+    assert bucket.delay(now) == 0.5
+    # Через полсекунды появляется один токен, но не больше capacity
+    assert bucket.delay(now + 0.5) == 0.0
+    assert bucket.delay(now + 100) == 0.0
+    assert bucket.tokens == 3
+
+def test_final_edit_of_unsent_message_is_sent_as_new_message(monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot.bot, 'send_message', lambda *args, **kwargs: sent.append((args, kwargs)) or 'message')
+    dispatcher = make_dispatcher()
+    status = bot.OutboundMessage(1)
+    status.resolve(error=http_error(502))
+
+    progress = bot.OutboundOp('edit_message_text', ('часть',), {}, target=status)
+    assert dispatcher._execute(progress) is None
+    assert sent == []
+
+    final = bot.OutboundOp('edit_message_text', ('ответ',), {'parse_mode': 'HTML'}, target=status, send_if_missing=True)
+    assert dispatcher._execute(final) is None
+    assert sent == [((1, 'ответ'), {'parse_mode': 'HTML'})]
+
+def test_final_edit_of_cancelled_message_is_dropped(monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot.bot, 'send_message', lambda *args, **kwargs: sent.append(args))
+    dispatcher = make_dispatcher()
+    status = bot.OutboundMessage(1)
+    status.cancelled = True
+    status.resolve()
+    final = bot.OutboundOp('edit_message_text', ('ответ',), {}, target=status, send_if_missing=True)
+    assert dispatcher._execute(final) is None
+    assert sent == []
@@ -0,0 +1,31 @@
+"""Тесты хранилищ истории (MemoryHistoryStore, SQLiteHistoryStore)"""
+import pytest
+
+import bot
+
+def test_history_store_is_abstract():
+    with pytest.raises(TypeError):
+        bot.HistoryStore()
+
+def test_memory_store_keeps_last_records_and_evicts_idle_chats():
+    store = bot.MemoryHistoryStore(per_chat=2, max_bytes=400)
+    for i in range(3):
+        store.append(1, f"вопрос {i}", "ответ")
+    assert [r.question for r in store.get(1)] == ["вопрос 1", "вопрос 2"]
+    store.append(2, "вопрос", "ответ" * 50)
+    assert store.get(1) == []
+    assert store.stats()["evicted_chats"] == 1
+
+def test_sqlite_store_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    first = bot.SQLiteHistoryStore(path, per_chat=3, flush_interval=60)
+    second = bot.SQLiteHistoryStore(path, per_chat=3, flush_interval=60)
+    first.append(1, "вопрос 1", "ответ")
+    first.flush()
+    second.append(1, "вопрос 2", "ответ")
+    second.flush()
+    for i in range(3, 5):
+        first.append(1, f"вопрос {i}", "ответ")
+    expected = ["вопрос 2", "вопрос 3", "вопрос 4"]
+    assert [r.question for r in first.get(1)] == expected
+    assert [r.question for r in second.get(1)] == expected
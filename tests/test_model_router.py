@@ -0,0 +1,114 @@
+"""Тесты маршрутизации запросов к моделям (ModelRouter)"""
+import time
+
+import bot
+
+class FakeClient:
+    """Отвечает с заданной задержкой для каждой модели"""
+
+    def __init__(self, delays):
+        self.delays = delays
+
+    def chat(self, prompt, model=None):
+        if self.delays[model] is None:
+            return bot.CIRCUIT_OPEN_ANSWER
+        time.sleep(self.delays[model])
+        return f"ответ {model}"
+
+    def chat_stream(self, prompt, on_delta, model=None):
+        time.sleep(self.delays[model])
+        on_delta(f"ответ {model}")
+        return f"ответ {model}"
+
+def make_router(delays, models, limiter=None):
+    return bot.ModelRouter(
+        client=FakeClient(delays),
+        models=models,
+        fast_model='',
+        fast_prompt_chars=0,
+        hedge=True,
+        hedge_min_delay=0.05,
+        hedge_max_delay=0.1,
+        window=10,
+        limiter=limiter
+    )
+
+def learn_latency(router, model, seconds):
+    """Заполняет статистику модели, чтобы полный ответ можно было дублировать"""
+    for _ in range(10):
+        router._record(model, 'full', seconds, True)
+
+def test_slow_model_without_fallback_does_not_spin():
+    router = make_router({'slow': 1.0}, ['slow'])
+    for call in (lambda: router.chat('вопрос'), lambda: router.chat_stream('вопрос', lambda text: None)):
+        cpu = time.process_time()
+        assert call() == "ответ slow"
+        assert time.process_time() - cpu < 0.3
+
+def test_slow_model_after_hedge_does_not_spin():
+    router = make_router({'slow': 1.0, 'slower': 1.5}, ['slow', 'slower'])
+    learn_latency(router, 'slow', 0.05)
+    cpu = time.process_time()
+    assert router.chat('вопрос') == "ответ slow"
+    assert time.process_time() - cpu < 0.3
+    assert router.stats()['hedges'] == 1
+
+def test_hedged_request_wins_over_slow_primary():
+    router = make_router({'slow': 1.0, 'fast': 0.01}, ['slow', 'fast'])
+    learn_latency(router, 'slow', 0.05)
+    start = time.monotonic()
+    assert router.chat('вопрос') == "ответ fast"
+    assert time.monotonic() - start < 0.5
+    assert router.stats()['hedge_wins'] == 1
+
+def test_full_answer_is_not_hedged_without_latency_stats():
+    router = make_router({'slow': 0.3, 'fast': 0.01}, ['slow', 'fast'])
+    assert router.chat('вопрос') == "ответ slow"
+    assert router.stats()['hedges'] == 0
+
+def test_hedge_needs_a_free_limiter_slot():
+    limiter = bot.StageLimiter('test', 1)
+    router = make_router({'slow': 0.3, 'fast': 0.01}, ['slow', 'fast'], limiter)
+    learn_latency(router, 'slow', 0.05)
+    with limiter:
+        # Единственный слот занят основным запросом
+        assert router.chat('вопрос') == "ответ slow"
+    assert router.stats()['hedges'] == 0
+
+def test_hedge_slot_is_released_after_all_requests_finish():
+    limiter = bot.StageLimiter('test', 2)
+    router = make_router({'slow': 0.5, 'fast': 0.01}, ['slow', 'fast'], limiter)
+    learn_latency(router, 'slow', 0.05)
+    with limiter:
+        assert router.chat('вопрос') == "ответ fast"
+    # Проигравший запрос еще идет и держит слот запасного
+    assert limiter.stats()['in_flight'] == 1
+    time.sleep(0.7)
+    assert limiter.stats()['in_flight'] == 0
+
+def test_open_breaker_passes_question_to_next_model():
+    router = make_router({'broken': None, 'good': 0.01}, ['broken', 'good'])
+    assert router.chat('вопрос') == "ответ good"
+    stats = router.stats()
+    assert stats['fallbacks'] == 1
+    # Отклоненный автоматом запрос не считается ошибкой модели
+    assert stats['models']['broken']['requests'] == 0
+
+def test_each_model_has_its_own_breaker():
+    client = bot.OpenRouterClient(
+        base_url='http://127.0.0.1:9',
+        headers={},
+        model='primary',
+        connect_timeout=1,
+        read_timeout=1,
+        max_retries=0,
+        max_backoff=0,
+        pool_size=1,
+        breaker_threshold=2,
+        breaker_reset=60
+    )
+    for _ in range(2):
+        client.breaker('primary').record_failure()
+    assert not client.breaker('primary').allow()
+    assert client.breaker('fallback').allow()
+    assert client.breaker().allow()
@@ -0,0 +1,61 @@
+"""Тесты кэша OCR (image_key, OCRCache)"""
+import io
+import os
+import sys
+
+from PIL import Image
+
+import bot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark'))
+
+from corpus import generate_corpus
+
+def corpus_images(count):
+    return [Image.open(io.BytesIO(data)) for _, data, _ in generate_corpus(count)]
+
+def make_cache(path='', max_distance=0, disk_max_bytes=1024 * 1024):
+    return bot.OCRCache(
+        path=path,
+        max_entries=100,
+        max_bytes=1024 * 1024,
+        max_distance=max_distance,
+        disk_max_bytes=disk_max_bytes
+    )
+
+def test_different_pages_never_share_a_key():
+    keys = [bot.image_key(image) for image in corpus_images(12)]
+    assert len(set(keys)) == len(keys)
+
+def test_different_pages_do_not_hit_each_other():
+    cache = make_cache()
+    images = corpus_images(12)
+    for i, image in enumerate(images):
+        assert cache.get_by_key(bot.image_key(image)) is None
+        cache.put(f"file-{i}", bot.image_key(image), f"страница {i}")
+    for i, image in enumerate(images):
+        assert cache.get_by_key(bot.image_key(image)) == f"страница {i}"
+
+def test_near_match_requires_same_size():
+    cache = make_cache(max_distance=8)
+    first, second = corpus_images(2)
+    cache.put('file-1', bot.image_key(first), "страница 1")
+    size, phash = bot._parse_image_key(bot.image_key(first))
+    assert cache.get_by_key(f"{size}:{phash ^ 0b111:064x}") == "страница 1"
+    assert cache.get_by_key(f"1x1:{phash:064x}") is None
+    assert cache.get_by_key(bot.image_key(second)) is None
+
+def test_disk_cache_survives_restart_and_is_trimmed(tmp_path):
+    path = os.path.join(tmp_path, 'ocr.sqlite3')
+    cache = make_cache(path, disk_max_bytes=1000)
+    for i in range(120):
+        cache.put(f"file-{i}", f"10x10:{i:064x}", 'т' * 50)
+    restarted = make_cache(path, disk_max_bytes=1000)
+    assert restarted.get_by_file('file-119') == 'т' * 50
+    assert restarted.get_by_file('file-0') is None
+    db = restarted._db
+    images, size = db.execute("SELECT COUNT(*), SUM(size) FROM ocr_images").fetchone()
+    # Обрезка идет раз в 50 записей: после нее добавляется не больше 49
+    assert size <= 1000 + 49 * 100
+    files = db.execute("SELECT COUNT(*) FROM ocr_file_keys").fetchone()[0]
+    assert files == images
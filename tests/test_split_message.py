@@ -0,0 +1,25 @@
+"""Тесты деления длинного ответа на сообщения (split_message)"""
+import bot
+
+def test_short_text_is_one_message():
+    assert bot.split_message("ответ", 10) == ["ответ"]
+
+def test_text_is_split_on_newlines():
+    text = "первая строка\nвторая строка\nтретья"
+    assert bot.split_message(text, 30) == ["первая строка\nвторая строка", "третья"]
+
+def test_text_without_newlines_is_cut_at_limit():
+    chunks = bot.split_message("а" * 25, 10)
+    assert chunks == ["а" * 10, "а" * 10, "а" * 5]
+
+def test_newline_too_early_is_ignored():
+    # Перевод строки в первой половине дал бы слишком короткую часть
+    chunks = bot.split_message("аб\n" + "в" * 20, 10)
+    assert chunks[0] == "аб\n" + "в" * 7
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert "".join(chunks) == "аб\n" + "в" * 20
+
+def test_default_limit_is_telegram_limit():
+    chunks = bot.split_message("строка\n" * 2000)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= bot.TELEGRAM_MESSAGE_LIMIT for chunk in chunks)
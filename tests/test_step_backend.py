@@ -0,0 +1,39 @@
+"""Тесты общего для процессов хранилища шагов (SQLiteStepBackend)"""
+import sqlite3
+import time
+
+import telebot
+
+import bot
+
+def make_backend(path, ttl=60):
+    return bot.SQLiteStepBackend(str(path), ttl)
+
+def test_step_is_claimed_by_one_process_only(tmp_path):
+    path = tmp_path / 'steps.sqlite3'
+    first, second = make_backend(path), make_backend(path)
+    first.register_handler(1, telebot.Handler(bot.process_text_question, 'a', key='b'))
+    handlers = second.get_handlers(1)
+    assert [h.callback for h in handlers] == [bot.process_text_question]
+    assert handlers[0].args == ('a',)
+    assert handlers[0].kwargs == {'key': 'b'}
+    assert first.get_handlers(1) is None
+
+def test_chat_without_steps_does_not_take_write_lock(tmp_path):
+    path = tmp_path / 'steps.sqlite3'
+    backend = make_backend(path)
+    other = sqlite3.connect(str(path), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        start = time.monotonic()
+        assert backend.get_handlers(1) is None
+        assert time.monotonic() - start < 1
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+def test_expired_steps_are_dropped(tmp_path):
+    backend = make_backend(tmp_path / 'steps.sqlite3', ttl=0.05)
+    backend.register_handler(1, telebot.Handler(bot.process_text_question))
+    time.sleep(0.1)
+    assert backend.get_handlers(1) is None